@@ -0,0 +1,376 @@
+"""
+Correctness and load harness for the LearningAI analysis paths.
+
+Generates randomized note streams (keys, tempos, chord densities, note-on/off
+pairing) and checks that the optimized NoteBuffer/numpy implementations in
+LearningAI give the same answers as straightforward reference versions
+(the original dict-based algorithms, plus a sequential chord segmenter and
+a per-template chord matcher for HarmonyAnalyzer). A scaled-up run then checks
+throughput and peak memory on one very large session.
+
+Usage:
+    python analysis_harness.py                 # property checks + 1M-note load check
+    python analysis_harness.py --cases 500 --seed 7 --load-notes 0
+"""
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+from itertools import islice
+from collections import Counter
+
+import numpy as np
+
+from learning_ai import LearningAI
+from models import Note, NoteBuffer
+
+
+# ---------------------------------------------------------------------------
+# Random note streams
+# ---------------------------------------------------------------------------
+
+def generate_stream(rng, ai, length):
+    """
+    Generate a random note stream as a list of note dicts
+
+    Args:
+        rng: random.Random instance
+        ai: LearningAI (for its scale definitions)
+        length: Approximate number of note-on events
+
+    Returns:
+        List of note dicts in timestamp order
+    """
+    return [note.to_dict() for note in _stream_notes(rng, ai, length)]
+
+
+def _stream_notes(rng, ai, length):
+    scale = rng.choice(list(ai.scales.values()))
+    # Tempo from slow practice to fast runs, with varying steadiness
+    beat_ms = 60000 / rng.uniform(40, 200)
+    jitter = rng.choice([0.0, 0.05, 0.3, 0.8])
+    chord_density = rng.choice([0.0, 0.2, 0.6, 1.0])
+    # Sometimes wander outside the key, sometimes jump octaves
+    chromatic = rng.choice([0.0, 0.1, 0.4])
+    low = rng.randint(21, 72)
+    high = min(108, low + rng.choice([7, 12, 24, 36]))
+    paired = rng.random() < 0.7
+
+    timestamp = rng.randint(0, 10 ** 12)
+    emitted = 0
+    while emitted < length:
+        if rng.random() < chord_density:
+            root = rng.randint(low, high)
+            pitches = [root, root + rng.choice([3, 4]), root + 7]
+            if rng.random() < 0.3:
+                pitches.append(root + rng.choice([10, 11]))
+        else:
+            pitches = [rng.randint(low, high)]
+
+        onsets = []
+        for pitch in pitches:
+            if rng.random() >= chromatic:
+                # Snap to the nearest note of the scale
+                while pitch % 12 not in scale:
+                    pitch += 1
+            pitch = max(0, min(127, pitch))
+            # Near-simultaneous onsets within a chord
+            onset = timestamp + (rng.randint(0, 40) if len(pitches) > 1 else 0)
+            onsets.append((onset, pitch))
+            yield Note(pitch, rng.randint(1, 127), onset, True)
+            emitted += 1
+
+        if paired:
+            for onset, pitch in onsets:
+                yield Note(pitch, 0, onset + int(beat_ms * rng.uniform(0.3, 0.9)), False)
+
+        step = beat_ms * max(0.05, 1 + rng.uniform(-jitter, jitter))
+        if rng.random() < 0.05:
+            step += rng.uniform(2000, 10000)  # A pause
+        timestamp += int(step)
+
+
+# ---------------------------------------------------------------------------
+# Reference implementations (original dict-based algorithms)
+# ---------------------------------------------------------------------------
+
+def reference_identify_scale(ai, midi_notes):
+    if not midi_notes:
+        return {"scale": "", "confidence": 0}
+    unique_pitches = set(note % 12 for note in midi_notes)
+    best_match = ""
+    best_count = 0
+    for scale_name, scale_notes in ai.scales.items():
+        matches = sum(1 for pitch in unique_pitches if pitch in scale_notes)
+        non_matches = len(unique_pitches) - matches
+        match_score = matches - (non_matches * 0.5)
+        if match_score > best_count:
+            best_count = match_score
+            best_match = scale_name
+    confidence = min(1.0, best_count / 7) if unique_pitches else 0
+    return {"scale": best_match, "confidence": confidence}
+
+
+def reference_analyze_timing(notes):
+    if len(notes) < 4:
+        return False
+    intervals = []
+    sorted_notes = sorted(notes, key=lambda n: n['timestamp'])
+    for i in range(1, len(sorted_notes)):
+        interval = sorted_notes[i]['timestamp'] - sorted_notes[i - 1]['timestamp']
+        if 0 < interval < 2000:
+            intervals.append(interval)
+    if not intervals:
+        return False
+    mean_interval = np.mean(intervals)
+    cv = np.std(intervals) / mean_interval if mean_interval > 0 else 0
+    return bool(cv > 0.5)
+
+
+def reference_estimate_skill_level(notes):
+    if not notes:
+        return "beginner"
+    midi_notes = [n['midiNote'] for n in notes if n['isNoteOn']]
+    note_range = max(midi_notes) - min(midi_notes) if midi_notes else 0
+    unique_notes = len(set(midi_notes))
+    if note_range > 24 and unique_notes > 12:
+        return "advanced"
+    elif note_range > 12 and unique_notes > 7:
+        return "intermediate"
+    return "beginner"
+
+
+def reference_generate_suggestions(ai, notes):
+    if not notes:
+        return ai.beginner_suggestions[:3]
+    midi_notes = [n['midiNote'] for n in notes if n['isNoteOn']]
+    timing_issues = reference_analyze_timing([n for n in notes if n['isNoteOn']])
+    scale_info = reference_identify_scale(ai, midi_notes)
+    most_common_notes = [note for note, _ in Counter(n % 12 for n in midi_notes).most_common(3)]
+
+    suggestions = []
+    if scale_info['scale']:
+        suggestions.append(f"Try practicing the {scale_info['scale']} scale with both hands")
+    if timing_issues:
+        suggestions.append("Work on your timing with a metronome - your note spacing is uneven")
+    chord_suggestion = ai._generate_chord_suggestion(most_common_notes)
+    if chord_suggestion:
+        suggestions.append(chord_suggestion)
+    harmony_suggestion = ai.harmony.suggestion(
+        reference_analyze_harmony(ai, notes, scale_info['scale']))
+    if harmony_suggestion:
+        suggestions.append(harmony_suggestion)
+    suggestions.append("Focus on keeping your wrists relaxed while playing")
+
+    skill_level = reference_estimate_skill_level(notes)
+    if skill_level == "beginner":
+        suggestions.extend(ai.beginner_suggestions[:2])
+    elif skill_level == "intermediate":
+        suggestions.extend(ai.intermediate_suggestions[:2])
+    else:
+        suggestions.extend(ai.advanced_suggestions[:2])
+    return list(dict.fromkeys(suggestions))[:5]
+
+
+def reference_segment(notes, window_ms):
+    # Sequential scan: an event takes every onset within window_ms of its first one
+    onsets = sorted((n for n in notes if n['isNoteOn']), key=lambda n: n['timestamp'])
+    events = []
+    for note in onsets:
+        if events and note['timestamp'] - events[-1][0] <= window_ms:
+            events[-1][1].add(note['midiNote'] % 12)
+        else:
+            events.append((note['timestamp'], {note['midiNote'] % 12}))
+    return [(start, pitches) for start, pitches in events if len(pitches) >= 3]
+
+
+def reference_label(ai, pitches):
+    # One template at a time, in the analyzer's template order; first best wins
+    best_index, best_score, best_matches = -1, None, 0
+    index = 0
+    for quality, intervals in ai.harmony.qualities:
+        for root in range(12):
+            chord = {(root + i) % 12 for i in intervals}
+            matches = len(pitches & chord)
+            score = matches - 0.5 * (len(pitches) - matches) - 0.25 * (len(chord) - matches)
+            if best_score is None or score > best_score:
+                best_index, best_score, best_matches = index, score, matches
+            index += 1
+    return best_index if best_matches >= 3 else -1
+
+
+def reference_triad(ai, index):
+    quality = ai.harmony.template_qualities[index]
+    triad = {'Dominant 7th': 'Major', 'Major 7th': 'Major', 'Minor 7th': 'Minor'}.get(quality, quality)
+    return ai.harmony.template_roots[index], triad
+
+
+def reference_analyze_harmony(ai, notes, key):
+    changes = []
+    for start, pitches in reference_segment(notes, ai.harmony.onset_window_ms):
+        label = reference_label(ai, pitches)
+        if label < 0:
+            continue
+        if not changes or reference_triad(ai, changes[-1][1]) != reference_triad(ai, label):
+            changes.append((start, label))
+
+    chords = []
+    for i, (start, label) in enumerate(changes):
+        chords.append({
+            'timestamp': start,
+            'chord': ai.harmony.template_names[label],
+            'numeral': ai.harmony.roman_numeral(label, key),
+            'duration': changes[i + 1][0] - start if i + 1 < len(changes) else None,
+        })
+    return {
+        'key': key,
+        'chords': chords,
+        'progressions': ai.harmony._find_progressions(chords, key),
+        'transitions': ai.harmony._count_transitions(chords),
+        'harmonicRhythm': ai.harmony._harmonic_rhythm(chords),
+    }
+
+
+def reference_analyze_session(ai, session_data):
+    notes = list(session_data['notes'].values())
+    duration_mins = (session_data['endTime'] - session_data['startTime']) / 60000
+    black_keys = sum(1 for n in notes if n['midiNote'] % 12 in (1, 3, 6, 8, 10))
+    pressed = [n['midiNote'] for n in notes if n['isNoteOn']]
+    harmony = reference_analyze_harmony(ai, notes, reference_identify_scale(ai, pressed)['scale'])
+    return {
+        'duration': round(duration_mins, 1),
+        'totalNotes': len(notes),
+        'whiteKeys': len(notes) - black_keys,
+        'blackKeys': black_keys,
+        'suggestions': reference_generate_suggestions(ai, notes),
+        'scale': reference_identify_scale(ai, [n['midiNote'] for n in notes])['scale'],
+        'chordChanges': len(harmony['chords']),
+        'progressions': harmony['progressions'],
+        'harmonicRhythm': harmony['harmonicRhythm'],
+    }
+
+
+# ---------------------------------------------------------------------------
+# Checks
+# ---------------------------------------------------------------------------
+
+def check_equivalence(cases, seed):
+    """
+    Compare optimized and reference results on random streams
+
+    Returns:
+        List of failure descriptions (empty if everything agreed)
+    """
+    ai = LearningAI()
+    rng = random.Random(seed)
+    failures = []
+
+    for case in range(cases):
+        notes = generate_stream(rng, ai, rng.choice([0, 1, 3, 4, 10, 50, 300]))
+        buffer = NoteBuffer.from_dicts(notes)
+        pressed = [n for n in notes if n['isNoteOn']]
+        midi_notes = [n['midiNote'] for n in pressed]
+
+        session = {
+            'startTime': 0,
+            'endTime': rng.randint(0, 3600000),
+            # Firebase shape for the reference; the optimized path also gets the list shape
+            'notes': {f'n{i}': n for i, n in enumerate(notes)},
+        }
+
+        checks = [
+            ('identify_scale',
+             reference_identify_scale(ai, midi_notes),
+             ai.identify_scale(midi_notes)),
+            ('_analyze_timing',
+             reference_analyze_timing(pressed),
+             ai._analyze_timing(buffer.note_ons())),
+            ('_estimate_skill_level',
+             reference_estimate_skill_level(notes),
+             ai._estimate_skill_level(buffer)),
+            ('analyze_harmony',
+             reference_analyze_harmony(ai, notes, reference_identify_scale(ai, midi_notes)['scale']),
+             ai.analyze_harmony(buffer)),
+            ('generate_suggestions',
+             reference_generate_suggestions(ai, notes),
+             ai.generate_suggestions(buffer)),
+            ('analyze_session',
+             reference_analyze_session(ai, session),
+             ai.analyze_session(dict(session, notes=notes))),
+        ]
+        for name, expected, actual in checks:
+            if expected != actual:
+                failures.append(f"case {case} ({len(notes)} notes) {name}: "
+                                f"expected {expected!r}, got {actual!r}")
+    return failures
+
+
+def check_load(note_count, seed, max_seconds, max_mb):
+    """
+    Analyze one very large session and check time and peak memory
+
+    Returns:
+        List of failure descriptions (empty if within limits)
+    """
+    ai = LearningAI()
+    rng = random.Random(seed)
+
+    # Stream straight into the columnar buffer, no per-note dicts
+    start = time.perf_counter()
+    buffer = NoteBuffer()
+    for note in islice(_stream_notes(rng, ai, note_count), note_count):
+        buffer.append(note)
+    ingest_seconds = time.perf_counter() - start
+
+    # Peak memory = the stored session plus everything analysis allocates
+    tracemalloc.start()
+    analysis_start = time.perf_counter()
+    report = ai.analyze_session({'startTime': 0, 'endTime': 3600000, 'notes': buffer})
+    analysis_seconds = time.perf_counter() - analysis_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    columns_mb = buffer.nbytes() / (1024 * 1024)
+    peak_mb = columns_mb + peak / (1024 * 1024)
+
+    print(f"load: {len(buffer)} notes ({columns_mb:.1f} MB of columns), "
+          f"ingest {ingest_seconds:.2f}s ({len(buffer) / max(ingest_seconds, 1e-9):,.0f} notes/s), "
+          f"analysis {analysis_seconds:.2f}s ({len(buffer) / max(analysis_seconds, 1e-9):,.0f} notes/s), "
+          f"peak {peak_mb:.1f} MB")
+
+    failures = []
+    if report['totalNotes'] != len(buffer):
+        failures.append(f"load: report counted {report['totalNotes']} of {len(buffer)} notes")
+    if analysis_seconds > max_seconds:
+        failures.append(f"load: analysis took {analysis_seconds:.2f}s (limit {max_seconds}s)")
+    if peak_mb > max_mb:
+        failures.append(f"load: peak memory {peak_mb:.1f} MB (limit {max_mb} MB)")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cases', type=int, default=300, help='random streams to compare')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--load-notes', type=int, default=1000000,
+                        help='note events in the load check session (0 to skip)')
+    parser.add_argument('--max-seconds', type=float, default=20.0,
+                        help='time limit for analyzing the load session')
+    parser.add_argument('--max-mb', type=float, default=256.0,
+                        help='peak traced memory limit for the load check')
+    args = parser.parse_args(argv)
+
+    failures = check_equivalence(args.cases, args.seed)
+    print(f"equivalence: {args.cases} streams, {len(failures)} mismatches")
+
+    if args.load_notes:
+        failures += check_load(args.load_notes, args.seed, args.max_seconds, args.max_mb)
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,13 @@
 import os
-import json
 import time
 from pathlib import Path
 from flask import Flask, render_template, jsonify, request
 from flask_cors import CORS
 import learning_ai
+from models import Note, NoteBuffer, SeqOutOfWindow, parse_seq, parse_session_id
+from session_store import ShardedSessionStore
+from live_notes import RateLimitExceeded
+import snapshot
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -16,17 +19,10 @@ ai_engine = learning_ai.LearningAI()
 # Create data directory for local storage
 data_dir = Path('data')
 data_dir.mkdir(exist_ok=True)
-notes_file = data_dir / 'notes.json'
-sessions_file = data_dir / 'sessions.json'
 
-# Initialize local storage files if they don't exist
-if not notes_file.exists():
-    with open(notes_file, 'w') as f:
-        json.dump([], f)
-
-if not sessions_file.exists():
-    with open(sessions_file, 'w') as f:
-        json.dump({}, f)
+# Sessions are partitioned across shards (PIANO_SESSION_SHARDS, default 4),
+# each with its own file, cache and writer lock
+session_store = ShardedSessionStore(data_dir)
 
 @app.route('/')
 def index():
@@ -59,25 +55,27 @@ def get_suggestions():
                 'error': 'Missing notes or sessionId in request'
             }), 400
         
+        # Validate once at ingest
+        try:
+            session_id = parse_session_id(session_id)
+            notes = NoteBuffer.from_dicts(notes)
+        except ValueError as e:
+            return jsonify({
+                'error': f'Invalid request: {e}'
+            }), 400
+        
         # Generate suggestions using the AI engine
         suggestions = ai_engine.generate_suggestions(notes)
         
-        # Save suggestions to local storage
-        with open(sessions_file, 'r') as f:
-            sessions = json.load(f)
-        
-        if session_id not in sessions:
-            sessions[session_id] = {
-                'startTime': int(time.time() * 1000),
-                'notes': [],
-                'deviceInfo': 'Unknown Device'
-            }
-        
-        sessions[session_id]['aiSuggestions'] = suggestions
-        sessions[session_id]['lastAnalyzed'] = int(time.time() * 1000)
-        
-        with open(sessions_file, 'w') as f:
-            json.dump(sessions, f)
+        # Save suggestions to the session's shard
+        session_store.update_session(
+            session_id,
+            {
+                'ai_suggestions': suggestions,
+                'last_analyzed': int(time.time() * 1000)
+            },
+            defaults={'device_info': 'Unknown Device'}
+        )
         
         return jsonify({
             'suggestions': suggestions
@@ -118,6 +116,56 @@ def analyze_scale():
             'error': 'Failed to analyze scale'
         }), 500
 
+@app.route('/api/analyze-harmony', methods=['POST'])
+def analyze_harmony():
+    """
+    Analyze chord progressions and harmonic rhythm
+    Expected JSON body (either notes or a stored sessionId):
+    {
+        "notes": [{"midiNote": 60, "velocity": 100, "timestamp": 1623456789, "isNoteOn": true}, ...],
+        "sessionId": "12345"
+    }
+    """
+    try:
+        data = request.json
+        notes = data.get('notes')
+        session_id = data.get('sessionId')
+        
+        if notes:
+            try:
+                notes = NoteBuffer.from_dicts(notes)
+            except ValueError as e:
+                return jsonify({
+                    'error': f'Invalid note: {e}'
+                }), 400
+        elif session_id:
+            try:
+                session_id = parse_session_id(session_id)
+            except ValueError as e:
+                return jsonify({
+                    'error': f'Invalid request: {e}'
+                }), 400
+            session = session_store.get_session(session_id)
+            if session is None:
+                return jsonify({
+                    'error': 'Session not found'
+                }), 404
+            notes = session.notes
+        else:
+            return jsonify({
+                'error': 'Missing notes or sessionId in request'
+            }), 400
+        
+        harmony = ai_engine.analyze_harmony(notes)
+        
+        return jsonify(harmony)
+    
+    except Exception as e:
+        print(f"Error analyzing harmony: {e}")
+        return jsonify({
+            'error': 'Failed to analyze harmony'
+        }), 500
+
 @app.route('/api/progress-report', methods=['GET'])
 def progress_report():
     """
@@ -127,33 +175,27 @@ def progress_report():
     try:
         session_id = request.args.get('sessionId')
         
-        # Load sessions from local storage
-        with open(sessions_file, 'r') as f:
-            sessions_data = json.load(f)
-        
-        if not sessions_data:
+        if session_store.is_empty():
             return jsonify({
                 'error': 'No sessions found'
             }), 404
         
         if session_id:
-            # Get specific session data
-            if session_id not in sessions_data:
+            # Get specific session data from its shard
+            session_data = session_store.get_session(session_id)
+            if session_data is None:
                 return jsonify({
                     'error': 'Session not found'
                 }), 404
                 
-            session_data = sessions_data[session_id]
             # Analyze this specific session
             report = ai_engine.analyze_session(session_data)
         else:
             # Get the last 5 sessions for overall progress
-            # Sort sessions by start time and get the last 5
-            sorted_sessions = dict(sorted(
-                sessions_data.items(), 
-                key=lambda item: item[1].get('startTime', 0), 
-                reverse=True
-            )[:5])
+            # (merged newest-first across all shards)
+            sorted_sessions = {
+                s.id: s for s in session_store.get_sessions(limit=5)
+            }
             
             if not sorted_sessions:
                 return jsonify({
@@ -196,8 +238,10 @@ def save_note():
     Expected JSON body:
     {
         "note": {"midiNote": 60, "velocity": 100, "timestamp": 1623456789, "isNoteOn": true},
-        "sessionId": "12345"
+        "sessionId": "12345",
+        "seq": 17  # optional client sequence number (from 0), retries with the same seq are ignored
     }
+    A seq more than 65536 ahead of the last one received is rejected with 400.
     """
     try:
         data = request.json
@@ -209,56 +253,180 @@ def save_note():
                 'error': 'Missing note or sessionId in request'
             }), 400
         
-        # Add note to real-time notes
-        with open(notes_file, 'r') as f:
-            notes = json.load(f)
-        
-        # Keep only the last 20 notes (to simulate real-time)
-        if len(notes) >= 20:
-            notes.pop(0)
+        # Validate once at ingest
+        try:
+            session_id = parse_session_id(session_id)
+            seq = data.get('seq', note.get('seq') if isinstance(note, dict) else None)
+            if seq is not None:
+                seq = parse_seq(seq)
+            note = Note.from_dict(note)
+        except ValueError as e:
+            return jsonify({
+                'error': f'Invalid request: {e}'
+            }), 400
         
-        notes.append(note)
+        # Add note to real-time notes and the session, on the session's shard
+        try:
+            stored = session_store.append_note(
+                session_id,
+                note,
+                defaults={
+                    'device_info': 'Mobile Piano App',
+                    'mode': 'practice'
+                },
+                seq=seq
+            )
+        except RateLimitExceeded as e:
+            return rate_limited(e)
+        except SeqOutOfWindow as e:
+            return jsonify({
+                'error': f'Invalid note: {e}'
+            }), 400
         
-        with open(notes_file, 'w') as f:
-            json.dump(notes, f)
+        return jsonify({
+            'success': True,
+            'duplicate': not stored
+        })
+    
+    except Exception as e:
+        print(f"Error saving note: {e}")
+        return jsonify({
+            'error': 'Failed to save note'
+        }), 500
+
+# Largest batch accepted by /api/save-notes
+MAX_BATCH_NOTES = 10000
+
+@app.route('/api/save-notes', methods=['POST'])
+def save_notes():
+    """
+    Save a batch of notes, e.g. replaying notes queued while offline
+    Expected JSON body:
+    {
+        "notes": [{"midiNote": 60, "velocity": 100, "timestamp": 1623456789, "isNoteOn": true, "seq": 17}, ...],
+        "sessionId": "12345",
+        "idempotencyKey": "batch-abc"  # optional, or an Idempotency-Key header
+    }
+    Notes with a seq that the session already received are skipped. Either
+    every note has a seq or none does; a seq more than 65536 ahead of the
+    last one received rejects the whole batch with 400.
+    """
+    try:
+        data = request.json
+        notes = data.get('notes', [])
+        session_id = data.get('sessionId')
+        key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
         
-        # Add note to session
-        with open(sessions_file, 'r') as f:
-            sessions = json.load(f)
+        if not notes or not session_id:
+            return jsonify({
+                'error': 'Missing notes or sessionId in request'
+            }), 400
         
-        if session_id not in sessions:
-            sessions[session_id] = {
-                'startTime': int(time.time() * 1000),
-                'notes': [],
-                'deviceInfo': 'Mobile Piano App',
-                'mode': 'practice'
-            }
+        if len(notes) > MAX_BATCH_NOTES:
+            return jsonify({
+                'error': f'Too many notes in one request (max {MAX_BATCH_NOTES})'
+            }), 413
         
-        sessions[session_id]['notes'].append(note)
+        # Validate once at ingest
+        try:
+            session_id = parse_session_id(session_id)
+            seqs = [n.get('seq') if isinstance(n, dict) else None for n in notes]
+            if all(seq is None for seq in seqs):
+                seqs = None
+            elif any(seq is None for seq in seqs):
+                raise ValueError('seq must be set on every note or on none')
+            else:
+                seqs = [parse_seq(seq) for seq in seqs]
+            notes = NoteBuffer.from_dicts(notes)
+        except ValueError as e:
+            return jsonify({
+                'error': f'Invalid request: {e}'
+            }), 400
         
-        with open(sessions_file, 'w') as f:
-            json.dump(sessions, f)
+        try:
+            result = session_store.append_notes(
+                session_id,
+                notes,
+                seqs,
+                defaults={
+                    'device_info': 'Mobile Piano App',
+                    'mode': 'practice'
+                },
+                # A retried request gets the original answer without storing the notes again
+                key=str(key) if key else None
+            )
+        except RateLimitExceeded as e:
+            return rate_limited(e)
+        except SeqOutOfWindow as e:
+            return jsonify({
+                'error': f'Invalid note: {e}'
+            }), 400
         
+        result['success'] = True
+        return jsonify(result)
+    
+    except Exception as e:
+        print(f"Error saving notes: {e}")
         return jsonify({
-            'success': True
-        })
+            'error': 'Failed to save notes'
+        }), 500
+
+def rate_limited(error):
+    """429 response telling the client how long to back off"""
+    response = jsonify({
+        'error': 'Too many notes, slow down',
+        'retryAfterMs': error.retry_after_ms
+    })
+    response.headers['Retry-After'] = str(max(1, -(-error.retry_after_ms // 1000)))
+    return response, 429
+
+@app.route('/api/snapshot', methods=['POST'])
+def create_snapshot():
+    """
+    Write a consistent snapshot of all sessions to data/snapshots/
+    Ingest keeps running; it is only blocked while sessions are copied in memory.
+    Expected JSON body (optional):
+    {
+        "format": "binary"  # binary, json or firebase
+    }
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        fmt = data.get('format', 'binary')
+        extensions = {'binary': '.pmsnap', 'json': '.json', 'firebase': '.firebase.json'}
+        
+        if fmt not in extensions:
+            return jsonify({
+                'error': f"Unsupported snapshot format: {fmt}"
+            }), 400
+        
+        snapshots_dir = data_dir / 'snapshots'
+        snapshots_dir.mkdir(exist_ok=True)
+        path = snapshots_dir / f"sessions-{int(time.time() * 1000)}{extensions[fmt]}"
+        
+        stats = snapshot.snapshot_store(session_store, path, fmt)
+        stats['path'] = str(path)
+        
+        return jsonify(stats)
     
     except Exception as e:
-        print(f"Error saving note: {e}")
+        print(f"Error creating snapshot: {e}")
         return jsonify({
-            'error': 'Failed to save note'
+            'error': 'Failed to create snapshot'
         }), 500
 
 # Get real-time notes
 @app.route('/api/notes', methods=['GET'])
 def get_notes():
-    """Get real-time notes"""
+    """
+    Get real-time notes
+    Query parameter: sessionId (optional, only notes from that session)
+    """
     try:
-        with open(notes_file, 'r') as f:
-            notes = json.load(f)
+        notes = session_store.get_recent_notes(request.args.get('sessionId'))
         
         return jsonify({
-            'notes': notes
+            'notes': [n.to_dict() for n in notes]
         })
     
     except Exception as e:
@@ -272,17 +440,10 @@ def get_notes():
 def get_sessions():
     """Get all practice sessions"""
     try:
-        with open(sessions_file, 'r') as f:
-            sessions = json.load(f)
-        
-        # Format for easier consumption by the client
-        formatted_sessions = []
-        for session_id, session_data in sessions.items():
-            session_data['id'] = session_id
-            formatted_sessions.append(session_data)
-        
-        # Sort by start time (newest first)
-        formatted_sessions.sort(key=lambda s: s.get('startTime', 0), reverse=True)
+        # Scatter-gather across shards, merged by start time (newest first)
+        formatted_sessions = [
+            s.to_dict(include_id=True, include_internal=False) for s in session_store.get_sessions()
+        ]
         
         return jsonify({
             'sessions': formatted_sessions
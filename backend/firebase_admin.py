@@ -2,6 +2,7 @@ import os
 import firebase_admin
 from firebase_admin import credentials, db
 from datetime import datetime
+from models import NoteBuffer, Session
 
 class FirebaseAdmin:
     """
@@ -30,12 +31,15 @@ class FirebaseAdmin:
             limit: Maximum number of sessions to retrieve
             
         Returns:
-            Dict of session data
+            Dict of {sessionId: Session}
         """
         try:
             ref = db.reference('sessions')
             sessions = ref.order_by_child('startTime').limit_to_last(limit).get()
-            return sessions
+            return {
+                session_id: Session.from_dict(data, session_id)
+                for session_id, data in (sessions or {}).items()
+            }
         except Exception as e:
             print(f"Error retrieving sessions: {e}")
             return {}
@@ -48,11 +52,12 @@ class FirebaseAdmin:
             session_id: Session ID to retrieve
             
         Returns:
-            Session data dict or None if not found
+            Session or None if not found
         """
         try:
             ref = db.reference(f'sessions/{session_id}')
-            return ref.get()
+            data = ref.get()
+            return Session.from_dict(data, session_id) if data is not None else None
         except Exception as e:
             print(f"Error retrieving session {session_id}: {e}")
             return None
@@ -103,18 +108,11 @@ class FirebaseAdmin:
         Get current real-time notes being played
         
         Returns:
-            List of note objects
+            NoteBuffer of notes
         """
         try:
             ref = db.reference('notes')
-            notes_data = ref.get()
-            
-            notes = []
-            if notes_data:
-                for note_id, note in notes_data.items():
-                    notes.append(note)
-            
-            return notes
+            return NoteBuffer.from_stored(ref.get(), 'Firebase notes')
         except Exception as e:
             print(f"Error retrieving real-time notes: {e}")
-            return []
+            return NoteBuffer()
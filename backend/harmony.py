@@ -0,0 +1,301 @@
+import numpy as np
+from collections import Counter
+from models import NoteBuffer
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# Roman numeral for each interval above the tonic (before casing by chord quality)
+MAJOR_KEY_NUMERALS = ['I', 'bII', 'II', 'bIII', 'III', 'IV', '#IV', 'V', 'bVI', 'VI', 'bVII', 'VII']
+MINOR_KEY_NUMERALS = ['I', 'bII', 'II', 'III', '#III', 'IV', '#IV', 'V', 'VI', '#VI', 'VII', '#VII']
+
+
+class HarmonyAnalyzer:
+    """
+    Segments note streams into chord events and extracts progressions.
+
+    Runs in linear time over a session (plus a sort if notes arrive out of
+    order), so it can annotate long sessions.
+    """
+
+    def __init__(self, onset_window_ms=80):
+        # Onsets closer together than this are treated as one chord
+        self.onset_window_ms = onset_window_ms
+
+        # Chord qualities as intervals above the root; triads come first so
+        # they win ties against the matching seventh chord
+        self.qualities = [
+            ('Major', (0, 4, 7)),
+            ('Minor', (0, 3, 7)),
+            ('Diminished', (0, 3, 6)),
+            ('Dominant 7th', (0, 4, 7, 10)),
+            ('Major 7th', (0, 4, 7, 11)),
+            ('Minor 7th', (0, 3, 7, 10)),
+        ]
+
+        # Template matrix: one row per (quality, root), one column per pitch class
+        self.template_names = []
+        self.template_roots = []
+        self.template_qualities = []
+        # (root, triad quality), so a chord and its seventh count as one chord
+        self.template_triads = []
+        rows = []
+        for quality, intervals in self.qualities:
+            for root in range(12):
+                row = np.zeros(12, dtype=np.int64)
+                row[[(root + i) % 12 for i in intervals]] = 1
+                rows.append(row)
+                self.template_names.append(f"{NOTE_NAMES[root]} {quality}")
+                self.template_roots.append(root)
+                self.template_qualities.append(quality)
+                self.template_triads.append((root, _triad_quality(quality)))
+        self.templates = np.array(rows)
+        self.template_sizes = self.templates.sum(axis=1)
+
+        # Progressions worth practicing, by key mode (numerals without 7ths)
+        self.progressions = {
+            'Major': {
+                ('ii', 'V', 'I'): 'ii–V–I',
+                ('I', 'IV', 'V'): 'I–IV–V',
+                ('I', 'V', 'vi', 'IV'): 'I–V–vi–IV',
+                ('I', 'vi', 'IV', 'V'): 'I–vi–IV–V',
+            },
+            'Minor': {
+                ('ii°', 'V', 'i'): 'ii°–V–i',
+                ('i', 'iv', 'V'): 'i–iv–V',
+                ('i', 'VI', 'VII'): 'i–VI–VII',
+            },
+        }
+
+    def segment(self, notes):
+        """
+        Group simultaneous and near-simultaneous onsets into chord events
+
+        Args:
+            notes: NoteBuffer (or list of note dicts)
+
+        Returns:
+            Tuple of (onset timestamps, 12-column pitch-class matrix), one row
+            per event with at least three distinct pitch classes
+        """
+        notes = NoteBuffer.coerce(notes)
+        on_mask = notes.note_on_mask()
+        timestamps = notes.timestamp_array()[on_mask]
+        pitch_classes = notes.midi_array()[on_mask] % 12
+
+        if len(timestamps) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 12), dtype=np.int64)
+
+        # Live sessions are already in timestamp order, so skip the sort then
+        if np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps = timestamps[order]
+            pitch_classes = pitch_classes[order]
+
+        # The window is measured from each event's first onset, so an event
+        # never lasts longer than onset_window_ms and a fast passage can't
+        # chain into one long "chord"
+        start_indices = self._event_starts(timestamps)
+        is_start = np.zeros(len(timestamps), dtype=np.int64)
+        is_start[start_indices] = 1
+        group_ids = np.cumsum(is_start) - 1
+        starts = timestamps[start_indices]
+
+        # 0/1 flags, so one byte per cell
+        chroma = np.zeros((len(starts), 12), dtype=np.uint8)
+        chroma[group_ids, pitch_classes] = 1
+
+        is_chord = chroma.sum(axis=1) >= 3
+        return starts[is_chord], chroma[is_chord]
+
+    def _event_starts(self, timestamps):
+        # Onsets more than a window after the previous onset always start an
+        # event; only the stretches between those need the sequential scan
+        gap_starts = np.concatenate(([0], np.flatnonzero(np.diff(timestamps) > self.onset_window_ms) + 1))
+        if len(gap_starts) == len(timestamps):
+            return gap_starts
+
+        window = self.onset_window_ms
+        values = timestamps.tolist()
+        starts = []
+        for begin, end in zip(gap_starts.tolist(), gap_starts[1:].tolist() + [len(values)]):
+            event_start = values[begin]
+            starts.append(begin)
+            for i in range(begin + 1, end):
+                if values[i] - event_start > window:
+                    starts.append(i)
+                    event_start = values[i]
+        return np.array(starts, dtype=np.int64)
+
+    def label(self, chroma):
+        """
+        Label chord events by template match (vectorized over all events)
+
+        Args:
+            chroma: Pitch-class matrix from segment()
+
+        Returns:
+            Array of template indices, -1 where no chord matched well enough
+        """
+        if len(chroma) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        matches = chroma @ self.templates.T
+        extra = chroma.sum(axis=1)[:, None] - matches
+        missing = self.template_sizes[None, :] - matches
+
+        # Same penalty for out-of-chord notes as identify_scale, plus a small
+        # one for chord tones that weren't played
+        scores = matches - 0.5 * extra - 0.25 * missing
+        best = np.argmax(scores, axis=1)
+
+        # Require at least three chord tones
+        best_matches = matches[np.arange(len(best)), best]
+        return np.where(best_matches >= 3, best, -1)
+
+    def roman_numeral(self, template_index, key):
+        """
+        Roman numeral of a chord relative to a key such as 'C Major' or 'A Minor'
+
+        Returns:
+            Numeral string (e.g. 'V7', 'ii', 'vii°') or '' if the key is unknown
+        """
+        tonic, mode = _parse_key(key)
+        if tonic is None:
+            return ""
+
+        root = self.template_roots[template_index]
+        quality = self.template_qualities[template_index]
+        numerals = MINOR_KEY_NUMERALS if mode == 'Minor' else MAJOR_KEY_NUMERALS
+        numeral = numerals[(root - tonic) % 12]
+
+        if quality in ('Minor', 'Minor 7th', 'Diminished'):
+            numeral = numeral.lower()
+        if quality == 'Diminished':
+            numeral += '°'
+        elif quality == 'Major 7th':
+            numeral += 'maj7'
+        elif quality in ('Dominant 7th', 'Minor 7th'):
+            numeral += '7'
+        return numeral
+
+    def analyze(self, notes, key=""):
+        """
+        Analyze chords, progressions and harmonic rhythm in a note stream
+
+        Args:
+            notes: NoteBuffer (or list of note dicts)
+            key: Detected key, e.g. from LearningAI.identify_scale
+
+        Returns:
+            Dict with chord events, progression counts and harmonic rhythm
+        """
+        starts, chroma = self.segment(notes)
+        labels = self.label(chroma)
+
+        keep = labels >= 0
+        starts = starts[keep].tolist()
+        labels = labels[keep].tolist()
+
+        # Collapse repeated chords so each event is a chord change; adding
+        # or dropping the seventh (C Major -> C Major 7th) is not a change
+        changes = []
+        for timestamp, label in zip(starts, labels):
+            if not changes or self.template_triads[changes[-1][1]] != self.template_triads[label]:
+                changes.append((timestamp, label))
+
+        chords = []
+        for i, (timestamp, label) in enumerate(changes):
+            duration = changes[i + 1][0] - timestamp if i + 1 < len(changes) else None
+            chords.append({
+                'timestamp': timestamp,
+                'chord': self.template_names[label],
+                'numeral': self.roman_numeral(label, key),
+                'duration': duration,
+            })
+
+        return {
+            'key': key,
+            'chords': chords,
+            'progressions': self._find_progressions(chords, key),
+            'transitions': self._count_transitions(chords),
+            'harmonicRhythm': self._harmonic_rhythm(chords),
+        }
+
+    def _find_progressions(self, chords, key):
+        """Count known progressions in the sequence of chord changes"""
+        _, mode = _parse_key(key)
+        patterns = self.progressions.get(mode, {})
+        if not patterns:
+            return {}
+
+        # Match on the triad numeral, so V7 counts as V
+        numerals = [_strip_seventh(c['numeral']) for c in chords]
+
+        counts = Counter()
+        for length in {len(p) for p in patterns}:
+            for i in range(len(numerals) - length + 1):
+                name = patterns.get(tuple(numerals[i:i + length]))
+                if name:
+                    counts[name] += 1
+        return dict(counts.most_common())
+
+    def _count_transitions(self, chords):
+        """Most common chord-to-chord changes"""
+        pairs = Counter(
+            (chords[i]['chord'], chords[i + 1]['chord']) for i in range(len(chords) - 1)
+        )
+        return [
+            {'from': a, 'to': b, 'count': count} for (a, b), count in pairs.most_common(5)
+        ]
+
+    def _harmonic_rhythm(self, chords):
+        """Average time per chord and chord changes per minute"""
+        durations = [c['duration'] for c in chords if c['duration'] is not None]
+        if not durations:
+            return {'averageChordMs': 0, 'changesPerMinute': 0}
+
+        total_ms = sum(durations)
+        average_ms = total_ms / len(durations)
+        return {
+            'averageChordMs': round(average_ms),
+            'changesPerMinute': round(len(durations) * 60000 / total_ms, 1) if total_ms > 0 else 0,
+        }
+
+    def suggestion(self, analysis):
+        """
+        Turn a harmony analysis into a practice suggestion
+
+        Returns:
+            Suggestion string or '' if no chords were found
+        """
+        if analysis['progressions']:
+            name = next(iter(analysis['progressions']))
+            return f"Practice your {name} transitions"
+        if analysis['transitions']:
+            top = analysis['transitions'][0]
+            return f"Practice smooth transitions from {top['from']} to {top['to']}"
+        return ""
+
+
+def _parse_key(key):
+    """Split 'C Major' into (0, 'Major'); (None, '') if unknown"""
+    parts = key.split() if key else []
+    if len(parts) != 2 or parts[0] not in NOTE_NAMES:
+        return None, ""
+    return NOTE_NAMES.index(parts[0]), parts[1]
+
+
+def _triad_quality(quality):
+    """Quality of the triad a chord is built on ('Dominant 7th' -> 'Major')"""
+    if quality in ('Dominant 7th', 'Major 7th'):
+        return 'Major'
+    if quality == 'Minor 7th':
+        return 'Minor'
+    return quality
+
+
+def _strip_seventh(numeral):
+    for suffix in ('maj7', '7'):
+        if numeral.endswith(suffix):
+            return numeral[:-len(suffix)]
+    return numeral
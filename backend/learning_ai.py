@@ -1,6 +1,8 @@
 import numpy as np
 from datetime import datetime
 from collections import Counter
+from models import NoteBuffer, Session, BLACK_KEYS
+from harmony import HarmonyAnalyzer
 
 class LearningAI:
     """Simple rule-based AI for piano learning suggestions"""
@@ -41,6 +43,9 @@ class LearningAI:
             'F Minor': [5, 8, 0],
         }
         
+        # Chord segmentation and progression analysis
+        self.harmony = HarmonyAnalyzer()
+        
         # Suggestions by skill level
         self.beginner_suggestions = [
             "Try practicing the C major scale slowly",
@@ -66,30 +71,34 @@ class LearningAI:
             "Work on trills and ornaments for expressive playing",
         ]
     
-    def generate_suggestions(self, notes):
+    def generate_suggestions(self, notes, harmony=None):
         """
         Generate practice suggestions based on played notes
         
         Args:
-            notes: List of note objects with midiNote, velocity, timestamp and isNoteOn
+            notes: NoteBuffer (or list of note dicts with midiNote, velocity, timestamp and isNoteOn)
+            harmony: Result of analyze_harmony for the same notes, if the caller
+                already has it (optional)
             
         Returns:
             List of suggestion strings
         """
+        notes = NoteBuffer.coerce(notes)
         if not notes:
             return self.beginner_suggestions[:3]
         
-        # Extract just the MIDI note numbers that were pressed
-        midi_notes = [n['midiNote'] for n in notes if n['isNoteOn']]
+        # Keep just the notes that were pressed
+        pressed = notes.note_ons()
+        midi_notes = pressed.midi_array()
         
         # Analyze timing if we have timestamps
-        timing_issues = self._analyze_timing([n for n in notes if n['isNoteOn']])
+        timing_issues = self._analyze_timing(pressed)
         
         # Analyze scale/key
         scale_info = self.identify_scale(midi_notes)
         
         # Find which notes were played most frequently
-        note_counter = Counter([n % 12 for n in midi_notes])
+        note_counter = Counter((midi_notes % 12).tolist())
         most_common_notes = [note for note, _ in note_counter.most_common(3)]
         
         # Generate suggestions based on analysis
@@ -108,6 +117,13 @@ class LearningAI:
         if chord_suggestion:
             suggestions.append(chord_suggestion)
         
+        # Add progression suggestion if chord changes were played
+        if harmony is None:
+            harmony = self.harmony.analyze(notes, scale_info['scale'])
+        harmony_suggestion = self.harmony.suggestion(harmony)
+        if harmony_suggestion:
+            suggestions.append(harmony_suggestion)
+        
         # Add technique suggestions
         suggestions.append("Focus on keeping your wrists relaxed while playing")
         
@@ -129,17 +145,17 @@ class LearningAI:
         Identify which scale the notes likely belong to
         
         Args:
-            midi_notes: List of MIDI note numbers
+            midi_notes: List or numpy array of MIDI note numbers
             
         Returns:
             Dict with scale name and confidence
         """
-        if not midi_notes:
+        if len(midi_notes) == 0:
             return {"scale": "", "confidence": 0}
         
         # Convert to pitch classes (0-11, where 0 is C)
-        pitch_classes = [note % 12 for note in midi_notes]
-        unique_pitches = set(pitch_classes)
+        pitch_classes = np.asarray(midi_notes, dtype=np.int64) % 12
+        unique_pitches = set(np.unique(pitch_classes).tolist())
         
         # Check each scale for match
         best_match = ""
@@ -170,12 +186,27 @@ class LearningAI:
             "confidence": confidence
         }
     
+    def analyze_harmony(self, notes):
+        """
+        Analyze chord progressions and harmonic rhythm relative to the detected key
+        
+        Args:
+            notes: NoteBuffer (or list of note dicts)
+            
+        Returns:
+            Dict with key, chord events, progressions, transitions and harmonic rhythm
+        """
+        notes = NoteBuffer.coerce(notes)
+        midi_notes = notes.midi_array()[notes.note_on_mask()]
+        key = self.identify_scale(midi_notes)['scale']
+        return self.harmony.analyze(notes, key)
+    
     def _analyze_timing(self, notes):
         """
         Analyze timing consistency between notes
         
         Args:
-            notes: List of note objects with timestamps
+            notes: NoteBuffer of pressed notes
             
         Returns:
             True if timing issues detected, False otherwise
@@ -184,15 +215,10 @@ class LearningAI:
             return False
         
         # Calculate time intervals between successive notes
-        intervals = []
-        sorted_notes = sorted(notes, key=lambda n: n['timestamp'])
+        intervals = np.diff(np.sort(notes.timestamp_array()))
+        intervals = intervals[(intervals > 0) & (intervals < 2000)]  # Ignore pauses over 2 seconds
         
-        for i in range(1, len(sorted_notes)):
-            interval = sorted_notes[i]['timestamp'] - sorted_notes[i-1]['timestamp']
-            if interval > 0 and interval < 2000:  # Ignore pauses over 2 seconds
-                intervals.append(interval)
-        
-        if not intervals:
+        if len(intervals) == 0:
             return False
         
         # Calculate coefficient of variation (std dev / mean)
@@ -203,7 +229,7 @@ class LearningAI:
         cv = std_dev / mean_interval if mean_interval > 0 else 0
         
         # CV > 0.5 indicates significant timing inconsistency
-        return cv > 0.5
+        return bool(cv > 0.5)
     
     def _generate_chord_suggestion(self, common_notes):
         """Generate a chord suggestion based on most commonly played notes"""
@@ -225,17 +251,18 @@ class LearningAI:
     
     def _estimate_skill_level(self, notes):
         """Estimate the user's skill level based on notes played"""
+        notes = NoteBuffer.coerce(notes)
         if not notes:
             return "beginner"
         
         # Extract midi notes
-        midi_notes = [n['midiNote'] for n in notes if n['isNoteOn']]
+        midi_notes = notes.midi_array()[notes.note_on_mask()]
         
         # Look at note range as one indicator of skill
-        note_range = max(midi_notes) - min(midi_notes) if midi_notes else 0
+        note_range = int(midi_notes.max() - midi_notes.min()) if len(midi_notes) else 0
         
         # Count unique notes
-        unique_notes = len(set(midi_notes))
+        unique_notes = len(np.unique(midi_notes))
         
         # More advanced players tend to use wider range and more unique notes
         if note_range > 24 and unique_notes > 12:
@@ -250,34 +277,29 @@ class LearningAI:
         Analyze a single practice session
         
         Args:
-            session_data: Dict containing session info from Firebase
+            session_data: Session (or session dict from local storage or Firebase)
             
         Returns:
             Dict with analysis report
         """
-        # Extract notes from session
-        notes = []
-        if 'notes' in session_data and isinstance(session_data['notes'], dict):
-            for note_id, note_data in session_data['notes'].items():
-                notes.append(note_data)
+        session = Session.coerce(session_data)
+        notes = session.notes
         
         # Calculate session stats
-        start_time = session_data.get('startTime', 0)
-        end_time = session_data.get('endTime', datetime.now().timestamp() * 1000)
+        start_time = session.start_time or 0
+        end_time = session.end_time
+        if end_time is None:
+            end_time = datetime.now().timestamp() * 1000
         
         duration_mins = (end_time - start_time) / 60000
         
         # Note count by type (white keys vs black keys)
-        white_keys = 0
-        black_keys = 0
+        midi_notes = notes.midi_array()
+        black_keys = int(np.isin(midi_notes % 12, BLACK_KEYS).sum())
+        white_keys = len(notes) - black_keys
         
-        for note in notes:
-            midi_note = note.get('midiNote', 0)
-            note_in_octave = midi_note % 12
-            if note_in_octave in [1, 3, 6, 8, 10]:  # Black keys
-                black_keys += 1
-            else:
-                white_keys += 1
+        # Summarize harmony (the full chord list is available from analyze_harmony)
+        harmony = self.analyze_harmony(notes)
         
         # Generate report
         return {
@@ -285,8 +307,11 @@ class LearningAI:
             'totalNotes': len(notes),
             'whiteKeys': white_keys,
             'blackKeys': black_keys,
-            'suggestions': self.generate_suggestions(notes),
-            'scale': self.identify_scale([n.get('midiNote', 0) for n in notes])['scale'],
+            'suggestions': self.generate_suggestions(notes, harmony),
+            'scale': self.identify_scale(midi_notes)['scale'],
+            'chordChanges': len(harmony['chords']),
+            'progressions': harmony['progressions'],
+            'harmonicRhythm': harmony['harmonicRhythm'],
         }
     
     def analyze_progress(self, sessions_data):
@@ -294,7 +319,7 @@ class LearningAI:
         Analyze progress across multiple sessions
         
         Args:
-            sessions_data: Dict of session data from Firebase
+            sessions_data: Dict of {sessionId: Session} (or session dicts)
             
         Returns:
             Dict with progress report
@@ -305,25 +330,22 @@ class LearningAI:
             }
         
         # Extract data from sessions
-        all_notes = []
+        all_notes = NoteBuffer()
         session_counts = []
         practice_duration = 0
         
         for session_id, session_data in sessions_data.items():
+            session = Session.coerce(session_data, session_id)
+            
             # Extract session duration
-            start_time = session_data.get('startTime', 0)
-            end_time = session_data.get('endTime', start_time)
+            start_time = session.start_time or 0
+            end_time = session.end_time if session.end_time is not None else start_time
             session_duration = (end_time - start_time) / 60000  # in minutes
             practice_duration += session_duration
             
             # Count notes in this session
-            session_notes = []
-            if 'notes' in session_data and isinstance(session_data['notes'], dict):
-                for note_id, note_data in session_data['notes'].items():
-                    session_notes.append(note_data)
-                    all_notes.append(note_data)
-            
-            session_counts.append(len(session_notes))
+            all_notes.extend(session.notes)
+            session_counts.append(len(session.notes))
         
         # Calculate progress metrics
         avg_session_notes = sum(session_counts) / len(session_counts) if session_counts else 0
@@ -334,7 +356,7 @@ class LearningAI:
             # Simple linear regression slope check
             x = list(range(len(session_counts)))
             slope = np.polyfit(x, session_counts, 1)[0]
-            improving = slope > 0
+            improving = bool(slope > 0)
         
         # Generate progress report
         return {
@@ -348,22 +370,23 @@ class LearningAI:
     
     def _suggest_focus_area(self, notes):
         """Suggest a focus area based on playing history"""
+        notes = NoteBuffer.coerce(notes)
         if not notes:
             return "Basic scales and chord progressions"
         
         # Convert notes to pitch classes
-        pitch_classes = [n.get('midiNote', 0) % 12 for n in notes if n.get('isNoteOn', False)]
+        pitch_classes = notes.midi_array()[notes.note_on_mask()] % 12
         
         # Count occurrences of each pitch class
-        pitch_counter = Counter(pitch_classes)
+        pitch_counts = np.bincount(pitch_classes, minlength=12)
         
         # Check if any pitch classes are underrepresented
-        total = sum(pitch_counter.values())
+        total = int(pitch_counts.sum())
         expected_per_class = total / 12
         
         underplayed = []
         for pitch in range(12):
-            count = pitch_counter.get(pitch, 0)
+            count = pitch_counts[pitch]
             if count < expected_per_class * 0.5:  # Less than half expected frequency
                 note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
                 underplayed.append(note_names[pitch])
@@ -0,0 +1,253 @@
+import json
+import math
+import time
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from models import Note
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a session sends notes faster than its rate limit allows"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.3f}s")
+        # Seconds until the request would be admitted
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_ms(self):
+        return int(math.ceil(self.retry_after * 1000))
+
+
+class NoteRing:
+    """
+    Fixed-capacity ring of the most recent notes.
+
+    Columns are preallocated typed arrays, so appending is O(1) and the
+    ring never grows past its capacity.
+    """
+    __slots__ = ('capacity', '_midi', '_velocity', '_timestamp', '_on', '_next', 'total')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._midi = array('B', bytes(capacity))
+        self._velocity = array('B', bytes(capacity))
+        self._timestamp = array('q', [0]) * capacity
+        self._on = array('B', bytes(capacity))
+        self._next = 0
+        # Notes ever appended, including ones that have been overwritten
+        self.total = 0
+
+    def append(self, note):
+        i = self._next
+        self._midi[i] = note.midi_note
+        self._velocity[i] = note.velocity
+        self._timestamp[i] = note.timestamp
+        self._on[i] = 1 if note.is_note_on else 0
+        self._next = (i + 1) % self.capacity
+        self.total += 1
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def notes(self):
+        """Get the buffered notes, oldest first"""
+        count = len(self)
+        start = (self._next - count) % self.capacity
+        indices = [(start + k) % self.capacity for k in range(count)]
+        return [Note(self._midi[i], self._velocity[i], self._timestamp[i], bool(self._on[i]))
+                for i in indices]
+
+
+class TokenBucket:
+    """Per-session rate limiter: `rate` notes per second with bursts up to `burst`"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, count, now):
+        """
+        Take tokens for `count` notes
+
+        Returns:
+            0 if admitted, otherwise seconds to wait before retrying
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A batch larger than the burst size is admitted once the bucket is
+        # full and leaves it in debt, so the session still averages `rate`
+        needed = min(count, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= count
+            return 0
+        return max((needed - self.tokens) / self.rate, 1.0 / self.rate)
+
+
+class _LiveSession:
+    __slots__ = ('ring', 'bucket', 'replay_bucket')
+
+    def __init__(self, ring, bucket, replay_bucket):
+        self.ring = ring
+        self.bucket = bucket
+        # Batch replays are limited separately so a backlog upload doesn't
+        # starve the session's live notes
+        self.replay_bucket = replay_bucket
+
+
+class LiveNotes:
+    """
+    Bounded in-memory live notes, one ring buffer per session.
+
+    Memory is bounded by capacity x max_sessions; the least recently active
+    sessions are dropped (or spilled to disk if spill_dir is set) when the
+    limit is reached. Each session has its own token bucket, so one
+    runaway MIDI device only throttles itself.
+    """
+
+    def __init__(self, capacity=20, rate=50, burst=100, max_sessions=1000, spill_dir=None,
+                 replay_rate=2000, replay_burst=10000):
+        self.capacity = capacity
+        self.rate = rate
+        self.burst = burst
+        self.replay_rate = replay_rate
+        self.replay_burst = replay_burst
+        self.max_sessions = max_sessions
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            spill_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # sessionId -> _LiveSession, least recently active first
+        self._sessions = OrderedDict()
+
+    def admit(self, session_id, count=1, now=None, replay=False):
+        """
+        Check a session's rate limit before ingesting `count` notes
+
+        Args:
+            session_id: Session sending the notes
+            count: Number of notes
+            now: time.monotonic() timestamp (optional)
+            replay: Charge the session's replay bucket (batch uploads of
+                buffered notes) instead of its live one
+
+        Raises:
+            RateLimitExceeded: If the session must back off
+        """
+        now = time.monotonic() if now is None else now
+        live = self._get(session_id, now)
+        with self._lock:
+            bucket = live.replay_bucket if replay else live.bucket
+            retry_after = bucket.take(count, now)
+        if retry_after:
+            raise RateLimitExceeded(retry_after)
+
+    def append(self, session_id, note):
+        """Append a note to the session's ring in O(1)"""
+        live = self._get(session_id, time.monotonic())
+        with self._lock:
+            live.ring.append(note)
+
+    def recent(self, session_id, limit=None):
+        """
+        Get a session's buffered notes, oldest first
+
+        Reading never creates an entry, so it can't evict (or spill) an
+        active session.
+
+        Returns:
+            List of Notes (empty if the session has no live notes)
+        """
+        with self._lock:
+            live = self._sessions.get(session_id)
+            notes = live.ring.notes() if live is not None else None
+        if notes is None:
+            # Idle session: read its spill file, if any, without loading it
+            notes = self._read_spill(session_id)[0]
+        return notes[-limit:] if limit else notes
+
+    def all_recent(self):
+        """Get buffered notes from every in-memory session, one list per session"""
+        with self._lock:
+            return [live.ring.notes() for live in self._sessions.values()]
+
+    def _get(self, session_id, now):
+        # Spill files are read and written outside the lock, so one
+        # session's disk I/O never stalls the others
+        with self._lock:
+            live = self._sessions.get(session_id)
+            if live is not None:
+                self._sessions.move_to_end(session_id)
+                return live
+
+        spilled = self._unspill(session_id)
+
+        evicted = []
+        with self._lock:
+            live = self._sessions.get(session_id)
+            if live is None:
+                live = _LiveSession(NoteRing(self.capacity),
+                                    TokenBucket(self.rate, self.burst, now),
+                                    TokenBucket(self.replay_rate, self.replay_burst, now))
+                self._sessions[session_id] = live
+                while len(self._sessions) > self.max_sessions:
+                    old_id, old_live = self._sessions.popitem(last=False)
+                    evicted.append((old_id, old_live.ring.notes()))
+            else:
+                self._sessions.move_to_end(session_id)
+            if spilled:
+                # Another request may have recreated the ring meanwhile;
+                # the spilled notes are older than anything in it
+                ring = NoteRing(self.capacity)
+                for note in spilled + live.ring.notes():
+                    ring.append(note)
+                live.ring = ring
+
+        for old_id, notes in evicted:
+            self._spill(old_id, notes)
+        return live
+
+    def _spill_path(self, session_id):
+        # Session IDs come from clients, so don't use them as file names
+        digest = hashlib.sha1(str(session_id).encode('utf-8')).hexdigest()
+        return self.spill_dir / f"{digest}.json"
+
+    def _spill(self, session_id, notes):
+        if self.spill_dir is None or not notes:
+            return
+        try:
+            with open(self._spill_path(session_id), 'w') as f:
+                json.dump({'sessionId': session_id, 'notes': [n.to_dict() for n in notes]}, f)
+        except OSError as e:
+            print(f"Error spilling live notes for session {session_id}: {e}")
+
+    def _read_spill(self, session_id):
+        # Returns (notes, path of the spill file or None)
+        if self.spill_dir is None:
+            return [], None
+        path = self._spill_path(session_id)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            return [Note.from_stored(n) for n in data.get('notes', [])], path
+        except FileNotFoundError:
+            return [], None
+        except (OSError, ValueError) as e:
+            print(f"Error loading spilled live notes for session {session_id}: {e}")
+            return [], None
+
+    def _unspill(self, session_id):
+        notes, path = self._read_spill(session_id)
+        if path is not None:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                # A concurrent request for the same session took it first
+                return []
+        return notes
@@ -0,0 +1,528 @@
+import json
+from array import array
+from itertools import compress
+
+import numpy as np
+
+# Black keys within an octave (0 = C, 1 = C#, etc.)
+BLACK_KEYS = (1, 3, 6, 8, 10)
+
+
+class Note:
+    """
+    A single note event (key press or release).
+
+    Validated once when built from client JSON, so analysis code can
+    use the attributes directly.
+    """
+    __slots__ = ('midi_note', 'velocity', 'timestamp', 'is_note_on')
+
+    def __init__(self, midi_note, velocity=100, timestamp=0, is_note_on=True):
+        self.midi_note = midi_note
+        self.velocity = velocity
+        self.timestamp = timestamp
+        self.is_note_on = is_note_on
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a validated note from its JSON form
+
+        Args:
+            data: Dict with midiNote and optional velocity, timestamp and isNoteOn
+
+        Returns:
+            Note instance
+
+        Raises:
+            ValueError: If the note is malformed
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"Note must be an object, got {type(data).__name__}")
+
+        midi_note = _check_int(data.get('midiNote'), 'midiNote', 0, 127)
+        velocity = _check_int(data.get('velocity', 100), 'velocity', 0, 127)
+        # Timestamps are epoch milliseconds; fractional values are truncated
+        timestamp = _check_int(data.get('timestamp', 0), 'timestamp', 0, None, truncate=True)
+
+        is_note_on = data.get('isNoteOn', True)
+        if not isinstance(is_note_on, bool):
+            raise ValueError("isNoteOn must be a boolean")
+
+        return cls(midi_note, velocity, timestamp, is_note_on)
+
+    @classmethod
+    def from_stored(cls, data):
+        """
+        Build a note from data that is already stored
+
+        Stored notes were accepted by older versions or written by other
+        clients, so anything that fits the note columns is kept as-is
+        (e.g. velocity 128, or isNoteOn stored as 0/1) instead of being
+        held to the ingest rules of from_dict.
+
+        Raises:
+            ValueError: If the note cannot be represented at all
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"Note must be an object, got {type(data).__name__}")
+
+        midi_note = _check_int(data.get('midiNote'), 'midiNote', 0, 255, truncate=True)
+        velocity = _check_int(data.get('velocity', 100), 'velocity', 0, 255, truncate=True)
+        timestamp = _check_int(data.get('timestamp', 0), 'timestamp',
+                               -2 ** 63, 2 ** 63 - 1, truncate=True)
+
+        is_note_on = data.get('isNoteOn', True)
+        if is_note_on in (0, 1):
+            is_note_on = bool(is_note_on)
+        elif not isinstance(is_note_on, bool):
+            raise ValueError("isNoteOn must be a boolean")
+
+        return cls(midi_note, velocity, timestamp, is_note_on)
+
+    def to_dict(self):
+        """Convert to the JSON form used by the API and storage"""
+        return {
+            'midiNote': self.midi_note,
+            'velocity': self.velocity,
+            'timestamp': self.timestamp,
+            'isNoteOn': self.is_note_on,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Note):
+            return NotImplemented
+        return (self.midi_note, self.velocity, self.timestamp, self.is_note_on) == \
+            (other.midi_note, other.velocity, other.timestamp, other.is_note_on)
+
+    def __repr__(self):
+        return (f"Note(midi_note={self.midi_note}, velocity={self.velocity}, "
+                f"timestamp={self.timestamp}, is_note_on={self.is_note_on})")
+
+
+def _check_int(value, name, minimum, maximum, truncate=False):
+    # bool is a subclass of int, but True is not a valid MIDI note
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name} must be a number")
+    if isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError(f"{name} must be finite")
+        if not truncate and not value.is_integer():
+            raise ValueError(f"{name} must be a whole number")
+        value = int(value)
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"{name} out of range: {value}")
+    return value
+
+
+class NoteBuffer:
+    """
+    Columnar, array-backed sequence of notes.
+
+    Stores each field in a typed array (about 11 bytes per note instead of
+    a dict per note) and exposes numpy columns for vectorized analysis.
+    """
+    __slots__ = ('_midi', '_velocity', '_timestamp', '_on')
+
+    def __init__(self, notes=()):
+        self._midi = array('B')
+        self._velocity = array('B')
+        self._timestamp = array('q')
+        self._on = array('B')
+        for note in notes:
+            self.append(note)
+
+    @classmethod
+    def coerce(cls, notes):
+        """
+        Normalize any supported note collection into a NoteBuffer
+
+        Args:
+            notes: NoteBuffer, list of Note objects or note dicts, or a
+                Firebase-style dict of {noteId: note}
+
+        Returns:
+            NoteBuffer (the same object if one was passed in)
+        """
+        if isinstance(notes, cls):
+            return notes
+        if notes is None:
+            return cls()
+        if isinstance(notes, dict):
+            notes = notes.values()
+        return cls.from_dicts(notes)
+
+    @classmethod
+    def from_dicts(cls, notes):
+        """
+        Validate and load notes from their JSON form
+
+        Raises:
+            ValueError: If any note is malformed
+        """
+        buffer = cls()
+        for note in notes:
+            if not isinstance(note, Note):
+                note = Note.from_dict(note)
+            buffer.append(note)
+        return buffer
+
+    @classmethod
+    def from_stored(cls, notes, source='stored data'):
+        """
+        Leniently load notes that are already stored (see Note.from_stored)
+
+        Notes that cannot be represented are skipped and reported, so one
+        bad note never makes a whole session or file unreadable.
+
+        Args:
+            notes: Anything coerce() accepts
+            source: Description of where the notes came from, for the report
+
+        Returns:
+            NoteBuffer
+        """
+        if isinstance(notes, cls):
+            return notes
+        if notes is None:
+            return cls()
+        if isinstance(notes, dict):
+            notes = notes.values()
+        elif not isinstance(notes, list):
+            print(f"Skipped notes in {source}: expected a list, got {type(notes).__name__}")
+            return cls()
+
+        buffer = cls()
+        skipped = 0
+        for note in notes:
+            try:
+                buffer.append(note if isinstance(note, Note) else Note.from_stored(note))
+            except ValueError as e:
+                if not skipped:
+                    print(f"Skipping malformed note in {source}: {e}")
+                skipped += 1
+        if skipped > 1:
+            print(f"Skipped {skipped} malformed notes in {source}")
+        return buffer
+
+    def append(self, note):
+        """Append a Note in O(1) amortized time"""
+        self._midi.append(note.midi_note)
+        self._velocity.append(note.velocity)
+        self._timestamp.append(note.timestamp)
+        self._on.append(1 if note.is_note_on else 0)
+
+    def extend(self, other):
+        """Append every note of another NoteBuffer"""
+        self._midi.extend(other._midi)
+        self._velocity.extend(other._velocity)
+        self._timestamp.extend(other._timestamp)
+        self._on.extend(other._on)
+
+    def copy(self):
+        """Independent copy (column memcpy, no per-note objects)"""
+        buffer = NoteBuffer()
+        buffer.extend(self)
+        return buffer
+
+    def __len__(self):
+        return len(self._midi)
+
+    def __getitem__(self, index):
+        return Note(self._midi[index], self._velocity[index],
+                    self._timestamp[index], bool(self._on[index]))
+
+    def __iter__(self):
+        for midi, velocity, timestamp, on in zip(self._midi, self._velocity,
+                                                 self._timestamp, self._on):
+            yield Note(midi, velocity, timestamp, bool(on))
+
+    # numpy columns are copies so the underlying arrays can keep growing
+    def midi_array(self):
+        return np.array(self._midi, dtype=np.int64)
+
+    def velocity_array(self):
+        return np.array(self._velocity, dtype=np.int64)
+
+    def timestamp_array(self):
+        return np.array(self._timestamp, dtype=np.int64)
+
+    def note_on_mask(self):
+        return np.array(self._on, dtype=bool)
+
+    def note_ons(self):
+        """Get only the key press events, as a new NoteBuffer"""
+        buffer = NoteBuffer()
+        buffer._midi = array('B', compress(self._midi, self._on))
+        buffer._velocity = array('B', compress(self._velocity, self._on))
+        buffer._timestamp = array('q', compress(self._timestamp, self._on))
+        buffer._on = array('B', [1]) * len(buffer._midi)
+        return buffer
+
+    def to_dicts(self):
+        """Convert to a list of note dicts for JSON output"""
+        return [
+            {'midiNote': midi, 'velocity': velocity, 'timestamp': timestamp, 'isNoteOn': bool(on)}
+            for midi, velocity, timestamp, on in zip(self._midi, self._velocity,
+                                                     self._timestamp, self._on)
+        ]
+
+    def columns(self):
+        """The raw column arrays (midi, velocity, timestamp, isNoteOn), not copies"""
+        return self._midi, self._velocity, self._timestamp, self._on
+
+    @classmethod
+    def from_columns(cls, midi, velocity, timestamp, on):
+        """
+        Build a buffer from typed column arrays (as returned by columns())
+
+        Raises:
+            ValueError: If the columns have different lengths
+        """
+        if not len(midi) == len(velocity) == len(timestamp) == len(on):
+            raise ValueError("Note columns have different lengths")
+        buffer = cls()
+        buffer._midi = array('B', midi)
+        buffer._velocity = array('B', velocity)
+        buffer._timestamp = array('q', timestamp)
+        buffer._on = array('B', on)
+        return buffer
+
+    def nbytes(self):
+        """Memory used by the note columns"""
+        return sum(len(col) * col.itemsize
+                   for col in (self._midi, self._velocity, self._timestamp, self._on))
+
+
+class SeqOutOfWindow(ValueError):
+    """Raised for a client sequence number too far ahead of what was received"""
+
+
+class SeqTracker:
+    """
+    Tracks which client sequence numbers a session has already received.
+
+    Everything up to high_water has been seen; seqs above it are recorded in
+    a bitmap (bit i = high_water + 1 + i), which collapses back into the
+    high-water mark as gaps fill in. In-order uploads keep the bitmap at 0.
+    Sequence numbers start at 0.
+    """
+    __slots__ = ('high_water', 'pending')
+
+    # How far ahead of the high-water mark a seq may be
+    WINDOW = 65536
+
+    def __init__(self, high_water=-1, pending=0):
+        self.high_water = high_water
+        self.pending = pending
+
+    def add(self, seq):
+        """
+        Record a sequence number
+
+        Returns:
+            True if it was new, False if it is a duplicate
+
+        Raises:
+            SeqOutOfWindow: If seq is more than WINDOW above the high-water
+                mark (accepting it would mark every seq below it as received)
+        """
+        if seq <= self.high_water:
+            return False
+
+        bit = seq - self.high_water - 1
+        if bit >= self.WINDOW:
+            raise SeqOutOfWindow(
+                f"seq {seq} is too far ahead of the last received seq {self.high_water} "
+                f"(at most {self.WINDOW} ahead)")
+
+        if self.pending >> bit & 1:
+            return False
+        self.pending |= 1 << bit
+
+        # Fold the run of received seqs right above the mark into it
+        run = (~self.pending & (self.pending + 1)).bit_length() - 1
+        if run:
+            self.high_water += run
+            self.pending >>= run
+        return True
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(int(data.get('highWater', -1)), int(data.get('pending', '0'), 16))
+
+    def to_dict(self):
+        return {'highWater': self.high_water, 'pending': format(self.pending, 'x')}
+
+    def copy(self):
+        return SeqTracker(self.high_water, self.pending)
+
+    def __bool__(self):
+        return self.high_water >= 0 or self.pending != 0
+
+
+def parse_seq(value):
+    """
+    Validate a client sequence number
+
+    Raises:
+        ValueError: If it is not a non-negative whole number
+    """
+    return _check_int(value, 'seq', 0, None)
+
+
+def parse_session_id(value):
+    """
+    Validate a client session ID and normalize it to a string
+
+    Session IDs are dict keys in the store and object keys in JSON, so a
+    numeric ID is stored as its string form.
+
+    Raises:
+        ValueError: If it is not a string or whole number
+    """
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        raise ValueError(f"sessionId must be a string, got {type(value).__name__}")
+    return str(value)
+
+
+class Session:
+    """
+    A practice session and its notes.
+
+    Accepts both storage shapes for notes (a local list or a Firebase
+    {noteId: note} dict) and always holds them as a NoteBuffer.
+    """
+    __slots__ = ('id', 'start_time', 'end_time', 'device_info', 'mode',
+                 'notes', 'ai_suggestions', 'last_analyzed', 'received',
+                 'request_results', 'extra')
+
+    # JSON key -> attribute, for the fields the backend understands
+    FIELDS = {
+        'startTime': 'start_time',
+        'endTime': 'end_time',
+        'deviceInfo': 'device_info',
+        'mode': 'mode',
+        'aiSuggestions': 'ai_suggestions',
+        'lastAnalyzed': 'last_analyzed',
+        'requestResults': 'request_results',
+    }
+
+    # Stored with the session but not part of its API representation
+    INTERNAL_FIELDS = {'requestResults'}
+
+    def __init__(self, session_id=None, start_time=0, end_time=None, device_info=None,
+                 mode=None, notes=None, ai_suggestions=None, last_analyzed=None,
+                 received=None, request_results=None, extra=None):
+        self.id = session_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.device_info = device_info
+        self.mode = mode
+        self.notes = notes if notes is not None else NoteBuffer()
+        self.ai_suggestions = ai_suggestions
+        self.last_analyzed = last_analyzed
+        # Client sequence numbers already ingested, for deduplicating retries
+        self.received = received if received is not None else SeqTracker()
+        # Idempotency key -> result of a batch upload, oldest first
+        self.request_results = request_results
+        # Unknown keys are kept so round-tripping never loses data
+        self.extra = extra if extra is not None else {}
+
+    @classmethod
+    def from_dict(cls, data, session_id=None):
+        """
+        Build a session from its stored JSON form
+
+        Notes are loaded leniently (see NoteBuffer.from_stored); client
+        input is validated separately at the API.
+
+        Args:
+            data: Session dict from local storage or Firebase
+            session_id: Session ID (defaults to data['id'] if present)
+
+        Returns:
+            Session instance
+        """
+        session = cls(session_id if session_id is not None else data.get('id'))
+        for key, value in data.items():
+            if key in cls.FIELDS:
+                setattr(session, cls.FIELDS[key], value)
+            elif key == 'notes':
+                session.notes = NoteBuffer.from_stored(value, f"session {session.id}")
+            elif key == 'received':
+                try:
+                    session.received = SeqTracker.from_dict(value)
+                except (AttributeError, TypeError, ValueError) as e:
+                    # Only costs deduplication of retries already in flight
+                    print(f"Resetting malformed received seqs in session {session.id}: {e}")
+            elif key != 'id':
+                session.extra[key] = value
+        return session
+
+    @classmethod
+    def coerce(cls, session, session_id=None):
+        """Normalize a Session or session dict into a Session"""
+        if isinstance(session, cls):
+            return session
+        return cls.from_dict(session or {}, session_id)
+
+    def to_dict(self, include_id=False, include_notes=True, include_internal=True):
+        """
+        Convert to the JSON form used by the API and storage
+
+        Args:
+            include_id: Add the session ID as 'id'
+            include_notes: Add the notes
+            include_internal: Add the ingest bookkeeping (received seqs and
+                cached idempotency results); pass False for API output
+        """
+        data = dict(self.extra)
+        for key, attr in self.FIELDS.items():
+            value = getattr(self, attr)
+            if value is not None and (include_internal or key not in self.INTERNAL_FIELDS):
+                data[key] = value
+        if include_notes:
+            data['notes'] = self.notes.to_dicts()
+        if include_internal and self.received:
+            data['received'] = self.received.to_dict()
+        if include_id:
+            data['id'] = self.id
+        return data
+
+    def copy(self):
+        """Snapshot of this session with its own note buffer"""
+        return Session(self.id, self.start_time, self.end_time, self.device_info, self.mode,
+                       self.notes.copy(), self.ai_suggestions, self.last_analyzed,
+                       self.received.copy(),
+                       dict(self.request_results) if self.request_results is not None else None,
+                       dict(self.extra))
+
+
+def dumps_sessions(sessions):
+    """Serialize a {sessionId: Session} dict to JSON"""
+    return json.dumps({session_id: s.to_dict() for session_id, s in sessions.items()})
+
+
+def loads_sessions(text):
+    """
+    Parse stored JSON into a {sessionId: Session} dict
+
+    Malformed sessions and notes are skipped and reported; only a file
+    that is not a JSON object of sessions is an error.
+
+    Raises:
+        ValueError: If the text is not a JSON object
+    """
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError(f"Sessions must be an object, got {type(data).__name__}")
+
+    sessions = {}
+    for session_id, session_data in data.items():
+        if not isinstance(session_data, dict):
+            print(f"Skipping malformed session {session_id}: "
+                  f"expected an object, got {type(session_data).__name__}")
+            continue
+        sessions[session_id] = Session.from_dict(session_data, session_id)
+    return sessions
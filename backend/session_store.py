@@ -0,0 +1,536 @@
+import os
+import json
+import atexit
+import time
+import zlib
+import heapq
+import threading
+from pathlib import Path
+from models import NoteBuffer, Session, SeqTracker, dumps_sessions, loads_sessions
+from live_notes import LiveNotes
+
+# Number of real-time notes returned by default (was the global last-20 list)
+RECENT_NOTES_LIMIT = 20
+
+# Idempotency keys remembered per session (the oldest are forgotten first)
+IDEMPOTENCY_KEYS_LIMIT = 64
+
+
+def configured_shard_count():
+    """Shard count from PIANO_SESSION_SHARDS (default 4)"""
+    return int(os.environ.get('PIANO_SESSION_SHARDS', 4))
+
+
+def shard_file(data_dir, index, shard_count):
+    """Path of one shard's sessions file (the shard count is part of the name)"""
+    return Path(data_dir) / f'sessions-{index}-of-{shard_count}.json'
+
+
+def shard_index(session_id, shard_count):
+    """Stable shard index for a session ID (same in every process)"""
+    return zlib.crc32(str(session_id).encode('utf-8')) % shard_count
+
+
+def read_manifest(data_dir):
+    """Shard count recorded in a data directory's shards.json, or None"""
+    manifest = Path(data_dir) / 'shards.json'
+    if not manifest.exists():
+        return None
+    with open(manifest, 'r') as f:
+        return json.load(f)['shardCount']
+
+
+def write_manifest(data_dir, shard_count):
+    """Record the shard count; this is the switch-over point of a rebalance"""
+    write_file(Path(data_dir) / 'shards.json', json.dumps({'shardCount': shard_count}))
+
+
+def load_sessions_file(path):
+    """
+    Load a sessions file
+
+    Returns:
+        Dict of {sessionId: Session} (empty if the file does not exist)
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If the file is not valid sessions JSON
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+    with open(path, 'r') as f:
+        return loads_sessions(f.read())
+
+
+def write_file(path, text):
+    """Write to a temp file and swap it in so readers never see a partial file"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SessionShard:
+    """
+    One partition of the session store.
+
+    Each shard owns its own sessions file, in-memory cache and lock, so
+    writes for sessions routed to different shards never contend.
+    Requests only update the cache and mark the session dirty; a
+    background writer rewrites the file at most once per flush interval,
+    re-serializing only the sessions that changed, and never while
+    holding the shard lock. Live notes are kept per session in the
+    shard's LiveNotes rings.
+    """
+
+    def __init__(self, index, data_dir, shard_count, live_options=None, flush_interval=None):
+        self.index = index
+        self.sessions_file = shard_file(data_dir, index, shard_count)
+        self.lock = threading.Lock()
+
+        # {sessionId: Session}
+        self.sessions = self._load()
+        self.live = LiveNotes(**(live_options or {}))
+
+        # Session IDs changed since the last flush, and the serialized JSON
+        # of every session as of its last flush
+        self._dirty = set()
+        self._serialized = {}
+        # Serializes flushes from the writer thread and explicit flush() calls
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._writer = None
+        if flush_interval is not None:
+            self._writer = threading.Thread(target=self._run_writer, args=(flush_interval,),
+                                            name=f'session-shard-{index}-writer', daemon=True)
+            self._writer.start()
+
+    def _load(self):
+        try:
+            return load_sessions_file(self.sessions_file)
+        except ValueError as e:
+            # Never let the next flush overwrite a file we could not read:
+            # move it aside for inspection and start the shard empty
+            quarantine = self.sessions_file.with_name(
+                f"{self.sessions_file.name}.corrupt-{int(time.time() * 1000)}")
+            os.replace(self.sessions_file, quarantine)
+            print(f"Error loading shard file {self.sessions_file}: {e}; "
+                  f"moved it to {quarantine}")
+            return {}
+
+    def mark_dirty(self, session_id):
+        """Schedule a session to be written. Caller must hold the shard lock."""
+        self._dirty.add(session_id)
+        self._wake.set()
+
+    def flush(self):
+        """
+        Write pending changes to the sessions file now
+
+        Does nothing unless this process changed a session, so a store that
+        only reads never rewrites the file. Dirty sessions (and, on the
+        first write, the ones not serialized yet) are copied under the
+        shard lock (column memcpy); serializing and writing happen after
+        it is released.
+
+        Raises:
+            OSError: If the file cannot be written (the changes stay pending)
+        """
+        with self._flush_lock:
+            with self.lock:
+                if not self._dirty:
+                    return
+                stale = self._dirty | (self.sessions.keys() - self._serialized.keys())
+                self._dirty = set()
+                copies = [self.sessions[session_id].copy() for session_id in stale]
+                order = list(self.sessions)
+
+            try:
+                for session in copies:
+                    self._serialized[session.id] = json.dumps(session.to_dict())
+                write_file(self.sessions_file, '{' + ', '.join(
+                    json.dumps(str(session_id)) + ': ' + self._serialized[session_id]
+                    for session_id in order) + '}')
+            except OSError:
+                with self.lock:
+                    self._dirty |= stale
+                raise
+
+    def _run_writer(self, interval):
+        while not self._stopped:
+            self._wake.wait()
+            # Let notes arriving meanwhile share this write
+            time.sleep(interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Error writing shard file {self.sessions_file}: {e}")
+                self._wake.set()
+
+    def close(self):
+        """Stop the background writer and flush what is still pending"""
+        self._stopped = True
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+
+    def session_list(self, limit=None):
+        """
+        Get this shard's sessions sorted newest first
+
+        Only the sessions returned are copied, so a small limit stays
+        cheap (and short under the lock) however many notes the shard holds.
+
+        Args:
+            limit: Maximum number of sessions to return (optional)
+
+        Returns:
+            List of Session snapshots
+        """
+        with self.lock:
+            if limit is None:
+                newest = sorted(self.sessions.values(), key=_recency, reverse=True)
+            else:
+                newest = heapq.nlargest(limit, self.sessions.values(), key=_recency)
+            return [session.copy() for session in newest]
+
+
+def _recency(session):
+    # Newest first; the ID breaks ties so the order is stable across shards
+    return (session.start_time or 0, str(session.id))
+
+
+class ShardedSessionStore:
+    """
+    Session store partitioned across several shards by session ID hash.
+
+    Requests for a single session are routed to exactly one shard; aggregate
+    queries scatter to every shard and merge the partial results.
+
+    Sharding keeps one session's lock holders (and its file writes) from
+    stalling the others, but all shards live in one process, so under the
+    GIL ingest throughput does not grow with the shard count (about 110-140k
+    notes/s from 8 threads with 1, 4 or 8 shards).
+    """
+
+    def __init__(self, data_dir, shard_count=None, flush_interval=None):
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(exist_ok=True)
+
+        if shard_count is None:
+            shard_count = configured_shard_count()
+        self.shard_count = max(1, shard_count)
+
+        # Seconds a change may wait before its shard file is rewritten
+        if flush_interval is None:
+            flush_interval = float(os.environ.get('PIANO_FLUSH_INTERVAL', 1.0))
+
+        # Live notes: per-session ring size, rate limit (notes/second and
+        # burst) and optional spill of idle sessions' rings to disk
+        spill = os.environ.get('PIANO_LIVE_SPILL', '') not in ('', '0')
+        self.live_options = {
+            'capacity': int(os.environ.get('PIANO_LIVE_CAPACITY', RECENT_NOTES_LIMIT)),
+            'rate': float(os.environ.get('PIANO_NOTE_RATE', 50)),
+            'burst': int(os.environ.get('PIANO_NOTE_BURST', 100)),
+            'max_sessions': int(os.environ.get('PIANO_LIVE_SESSIONS', 1000)),
+            # Batch replays have their own, much larger allowance
+            'replay_rate': float(os.environ.get('PIANO_REPLAY_RATE', 2000)),
+            'replay_burst': int(os.environ.get('PIANO_REPLAY_BURST', 10000)),
+        }
+
+        self._prepare_layout()
+
+        self.shards = []
+        for i in range(self.shard_count):
+            options = dict(self.live_options)
+            if spill:
+                options['spill_dir'] = self.data_dir / f'live-{i}'
+            self.shards.append(SessionShard(i, self.data_dir, self.shard_count,
+                                            options, flush_interval))
+        # Write out whatever is still pending when the process exits
+        atexit.register(self.close)
+
+    def _prepare_layout(self):
+        """
+        Make sure the on-disk shards match the configured shard count.
+
+        Imports the legacy single-file sessions.json on first start and
+        rebalances existing shard files when the shard count changes.
+        The new shard files and the manifest are written before any old
+        file is removed, so an interrupted rebalance leaves the previous
+        layout intact. Unreadable source files stop the start instead of
+        being dropped.
+        """
+        previous_count = read_manifest(self.data_dir)
+        if previous_count != self.shard_count:
+            sessions = {}
+            if previous_count is None:
+                # The legacy file is left in place as the original copy
+                sessions = load_sessions_file(self.data_dir / 'sessions.json')
+            else:
+                for i in range(previous_count):
+                    sessions.update(load_sessions_file(
+                        shard_file(self.data_dir, i, previous_count)))
+
+            partitions = [{} for _ in range(self.shard_count)]
+            for session_id, session in sessions.items():
+                partitions[self.shard_index(session_id)][session_id] = session
+            for i, partition in enumerate(partitions):
+                write_file(shard_file(self.data_dir, i, self.shard_count),
+                           dumps_sessions(partition))
+            write_manifest(self.data_dir, self.shard_count)
+
+        # Old-layout files (including ones left by an interrupted rebalance)
+        # are only removed once the manifest points at the new layout
+        for path in self.data_dir.glob('sessions-*-of-*.json'):
+            if not path.name.endswith(f'-of-{self.shard_count}.json'):
+                path.unlink()
+
+    def shard_index(self, session_id):
+        """Stable shard index for a session ID (same in every process)"""
+        return shard_index(session_id, self.shard_count)
+
+    def shard_for(self, session_id):
+        """Route a session ID to its shard"""
+        return self.shards[self.shard_index(session_id)]
+
+    def get_session(self, session_id):
+        """
+        Get a specific session by ID
+
+        Args:
+            session_id: Session ID to retrieve
+
+        Returns:
+            Session snapshot or None if not found
+        """
+        shard = self.shard_for(session_id)
+        with shard.lock:
+            session = shard.sessions.get(session_id)
+            return session.copy() if session is not None else None
+
+    def update_session(self, session_id, data, defaults):
+        """
+        Update a session with new data, creating it if needed
+
+        Args:
+            session_id: Session ID to update
+            data: Dict of Session attributes to set
+            defaults: Dict of Session attributes used when the session is created
+        """
+        shard = self.shard_for(session_id)
+        with shard.lock:
+            session = self._ensure_session(shard, session_id, defaults)
+            for attr, value in data.items():
+                setattr(session, attr, value)
+            shard.mark_dirty(session_id)
+
+    def append_note(self, session_id, note, defaults, seq=None):
+        """
+        Record a played note for a session and in the real-time notes
+
+        Args:
+            session_id: Session ID the note belongs to
+            note: Validated Note
+            defaults: Dict of Session attributes used when the session is created
+            seq: Client sequence number, used to drop retried duplicates (optional)
+
+        Returns:
+            True if the note was stored, False if it was a duplicate
+
+        Raises:
+            RateLimitExceeded: If the session is sending notes too fast
+            SeqOutOfWindow: If seq is too far ahead of the session's seqs
+        """
+        shard = self.shard_for(session_id)
+        # Backpressure is checked before any work so a flooding client is cheap to reject
+        shard.live.admit(session_id)
+
+        with shard.lock:
+            # Checked on a copy so a rejected seq leaves no trace
+            received = self._received(shard, session_id)
+            if seq is not None and not received.add(seq):
+                return False
+            session = self._ensure_session(shard, session_id, defaults)
+            session.received = received
+            session.notes.append(note)
+            shard.mark_dirty(session_id)
+
+        shard.live.append(session_id, note)
+        return True
+
+    def append_notes(self, session_id, notes, seqs, defaults, key=None):
+        """
+        Record a batch of notes (e.g. an offline replay) in one update
+
+        Args:
+            session_id: Session ID the notes belong to
+            notes: Validated NoteBuffer
+            seqs: Client sequence number per note, or None to skip deduplication
+            defaults: Dict of Session attributes used when the session is created
+            key: Idempotency key of the request (optional). The key is checked
+                and its result recorded in the same critical section as the
+                notes, and kept with the session, so a retry (even one racing
+                the original, or after a restart) is answered from the
+                original result instead of storing the batch again.
+
+        Returns:
+            Dict with accepted and duplicate counts and the session's
+            high-water mark (plus replayed=True for a repeated key)
+
+        Raises:
+            RateLimitExceeded: If the session is sending notes too fast
+            SeqOutOfWindow: If a seq is too far ahead of the session's seqs
+        """
+        shard = self.shard_for(session_id)
+        # A repeated key is answered without being charged again
+        if key is not None:
+            with shard.lock:
+                result = self._request_result(shard, session_id, key)
+            if result is not None:
+                return result
+
+        # Every note in the batch counts against the session's replay limit,
+        # which is separate from the live one used by append_note
+        shard.live.admit(session_id, count=len(notes), replay=True)
+
+        with shard.lock:
+            if key is not None:
+                # The original may have finished while this one was admitted
+                result = self._request_result(shard, session_id, key)
+                if result is not None:
+                    return result
+
+            # Seqs are checked on a copy so a rejected batch changes nothing
+            received = self._received(shard, session_id)
+            if seqs is not None:
+                new_notes = NoteBuffer()
+                for note, seq in zip(notes, seqs):
+                    if received.add(seq):
+                        new_notes.append(note)
+                notes_added = new_notes
+            else:
+                notes_added = notes
+            accepted = len(notes_added)
+
+            session = self._ensure_session(shard, session_id, defaults)
+            session.received = received
+            session.notes.extend(notes_added)
+            result = {
+                'accepted': accepted,
+                'duplicates': len(notes) - accepted,
+                'highWater': received.high_water,
+            }
+            if key is not None:
+                results = session.request_results = dict(session.request_results or {})
+                results[key] = result
+                while len(results) > IDEMPOTENCY_KEYS_LIMIT:
+                    del results[next(iter(results))]
+            if accepted or key is not None:
+                shard.mark_dirty(session_id)
+
+        return dict(result)
+
+    def _request_result(self, shard, session_id, key):
+        # Caller must hold the shard lock
+        session = shard.sessions.get(session_id)
+        result = (session.request_results or {}).get(key) if session is not None else None
+        return dict(result, replayed=True) if result is not None else None
+
+    def _received(self, shard, session_id):
+        # Copy of a session's seq tracker (a new one if the session doesn't exist yet)
+        session = shard.sessions.get(session_id)
+        return session.received.copy() if session is not None else SeqTracker()
+
+    def _ensure_session(self, shard, session_id, defaults):
+        if session_id not in shard.sessions:
+            session = Session(session_id, start_time=int(time.time() * 1000))
+            for attr, value in defaults.items():
+                setattr(session, attr, value)
+            shard.sessions[session_id] = session
+        return shard.sessions[session_id]
+
+    def get_recent_notes(self, session_id=None, limit=RECENT_NOTES_LIMIT):
+        """
+        Get real-time notes, optionally for a single session
+
+        Args:
+            session_id: Only return notes from this session (optional)
+            limit: Maximum number of notes to return
+
+        Returns:
+            List of Notes, oldest first
+        """
+        if session_id is not None:
+            return self.shard_for(session_id).live.recent(session_id, limit)
+
+        # Scatter to every session ring and merge by timestamp
+        partials = []
+        for shard in self.shards:
+            for notes in shard.live.all_recent():
+                partials.append(sorted(notes[-limit:], key=lambda n: n.timestamp))
+        merged = list(heapq.merge(*partials, key=lambda n: n.timestamp))
+        return merged[-limit:]
+
+    def get_sessions(self, limit=None):
+        """
+        Get sessions from every shard, newest first
+
+        Args:
+            limit: Maximum number of sessions to return (optional)
+
+        Returns:
+            List of Session snapshots
+        """
+        partials = [shard.session_list(limit) for shard in self.shards]
+        merged = heapq.merge(*partials, key=_recency, reverse=True)
+        sessions = []
+        for session_data in merged:
+            if limit is not None and len(sessions) >= limit:
+                break
+            sessions.append(session_data)
+        return sessions
+
+    def snapshot(self):
+        """
+        Consistent point-in-time copy of every session
+
+        All shard locks are held together, but only while the sessions are
+        copied (column memcpy); serializing the copy happens after ingest
+        has resumed.
+
+        Returns:
+            Dict of {sessionId: Session} snapshots
+        """
+        # Always acquired in shard order, and writers only ever hold one
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            sessions = {}
+            for shard in self.shards:
+                for session_id, session in shard.sessions.items():
+                    sessions[session_id] = session.copy()
+            return sessions
+        finally:
+            for shard in reversed(self.shards):
+                shard.lock.release()
+
+    def flush(self):
+        """Write every shard's pending changes now"""
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        """Stop the shard writers after flushing pending changes"""
+        for shard in self.shards:
+            shard.close()
+
+    def is_empty(self):
+        """True if no shard holds any session"""
+        return all(not shard.sessions for shard in self.shards)
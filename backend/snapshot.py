@@ -0,0 +1,508 @@
+"""
+Snapshots, restore and migration of the session store.
+
+Formats:
+    json      {sessionId: session} as in the legacy sessions.json
+    binary    Length-prefixed records with raw note columns (.pmsnap)
+    firebase  Firebase Realtime Database export ({"sessions": {...}}, notes keyed by ID)
+    shards    A sharded data directory as used by the server
+
+Every file written gets a `<file>.sha256` sidecar, and migrations compare a
+format-independent content digest of source and destination.
+
+Binary snapshots and data directories are read one session (or shard) at
+a time, and every format is written one session at a time. JSON and
+Firebase sources are parsed whole, since the json module can't stream.
+
+Usage:
+    python snapshot.py migrate data backup.pmsnap
+    python snapshot.py migrate export.json data-new --from firebase --shards 8
+    python snapshot.py verify backup.pmsnap
+"""
+import os
+import sys
+import json
+import time
+import struct
+import hashlib
+import argparse
+from array import array
+from pathlib import Path
+
+from models import NoteBuffer, Session
+
+FORMATS = ('json', 'binary', 'firebase', 'shards')
+
+BINARY_MAGIC = b'PMSNAP\x01\n'
+_SESSION_RECORD = b'S'
+_END_RECORD = b'E'
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot is malformed or fails checksum verification"""
+
+
+# ---------------------------------------------------------------------------
+# Checksums
+# ---------------------------------------------------------------------------
+
+class _HashingWriter:
+    """File wrapper that hashes and counts everything written"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.sha256.update(data)
+        self.bytes += len(data)
+        self.f.write(data)
+
+
+def _little_endian(column):
+    if sys.byteorder == 'big' and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _session_digest(session):
+    h = hashlib.sha256()
+    h.update(json.dumps([str(session.id), session.to_dict(include_notes=False)],
+                        sort_keys=True).encode('utf-8'))
+    for column in session.notes.columns():
+        h.update(_little_endian(column))
+    return h.digest()
+
+
+def _combine(digests):
+    # Sorted so the result does not depend on session order
+    total = hashlib.sha256()
+    for digest in sorted(digests):
+        total.update(digest)
+    return total.hexdigest()
+
+
+def content_digest(sessions):
+    """
+    Format-independent SHA-256 of session contents
+
+    Args:
+        sessions: Iterable of Sessions
+
+    Returns:
+        Hex digest; equal for the same sessions in any format or order
+    """
+    return _combine(_session_digest(session) for session in sessions)
+
+
+def _sidecar(path):
+    return path.with_name(path.name + '.sha256')
+
+
+def _write_sidecar(path, hex_digest):
+    with open(_sidecar(path), 'w') as f:
+        f.write(f"{hex_digest}  {path.name}\n")
+
+
+def verify_file(path):
+    """
+    Check a snapshot file against its .sha256 sidecar
+
+    Returns:
+        True if verified, False if there is no sidecar
+
+    Raises:
+        SnapshotError: If the checksum does not match
+    """
+    path = Path(path)
+    sidecar = _sidecar(path)
+    if not sidecar.exists():
+        return False
+
+    expected = sidecar.read_text().split()[0]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    if h.hexdigest() != expected:
+        raise SnapshotError(f"Checksum mismatch for {path}")
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Readers (generators of Sessions, one at a time)
+# ---------------------------------------------------------------------------
+
+def read_sessions(path, fmt):
+    """
+    Read sessions from a snapshot or data directory
+
+    Args:
+        path: File or directory
+        fmt: One of FORMATS
+
+    Returns:
+        Iterator of Sessions
+    """
+    path = Path(path)
+    if fmt == 'binary':
+        return _read_binary(path)
+    if fmt == 'shards':
+        return _read_shards(path)
+
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise SnapshotError(f"{path} is not a JSON object of sessions")
+    if fmt == 'firebase':
+        data = data.get('sessions') or {}
+    elif _is_firebase_export(data):
+        # Read as json, the wrapper would become one session named "sessions"
+        raise SnapshotError(f"{path} looks like a Firebase export; use --from firebase")
+    return (Session.from_dict(session_data, session_id)
+            for session_id, session_data in data.items()
+            if _is_session(session_id, session_data))
+
+
+def _is_firebase_export(data):
+    # {"sessions": {id: session}, "notes": ...} rather than {id: session}
+    sessions = data.get('sessions')
+    if not isinstance(sessions, dict) or not set(data) <= {'sessions', 'notes'}:
+        return False
+    session_keys = set(Session.FIELDS) | {'notes', 'received'}
+    return not session_keys & set(sessions)
+
+
+def _is_session(session_id, session_data):
+    if isinstance(session_data, dict):
+        return True
+    print(f"Skipping malformed session {session_id}: "
+          f"expected an object, got {type(session_data).__name__}")
+    return False
+
+
+def _read_exact(f, size, h):
+    data = f.read(size)
+    if len(data) != size:
+        raise SnapshotError("Snapshot is truncated")
+    h.update(data)
+    return data
+
+
+def _read_column(f, typecode, count, h):
+    column = array(typecode)
+    column.frombytes(_read_exact(f, count * column.itemsize, h))
+    if sys.byteorder == 'big' and column.itemsize > 1:
+        column.byteswap()
+    return column
+
+
+def _read_binary(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if _read_exact(f, len(BINARY_MAGIC), h) != BINARY_MAGIC:
+            raise SnapshotError(f"{path} is not a binary session snapshot")
+
+        count = 0
+        while True:
+            kind = f.read(1)
+            if kind == _END_RECORD:
+                expected_count, = struct.unpack('<Q', f.read(8))
+                expected_digest = f.read(32)
+                if expected_count != count or expected_digest != h.digest():
+                    raise SnapshotError(f"Checksum mismatch in {path}")
+                return
+            if kind != _SESSION_RECORD:
+                raise SnapshotError("Snapshot is truncated or corrupt")
+            h.update(kind)
+
+            meta_len, = struct.unpack('<I', _read_exact(f, 4, h))
+            session_id, meta = json.loads(_read_exact(f, meta_len, h))
+            note_count, = struct.unpack('<Q', _read_exact(f, 8, h))
+
+            session = Session.from_dict(meta, session_id)
+            session.notes = NoteBuffer.from_columns(
+                _read_column(f, 'B', note_count, h),
+                _read_column(f, 'B', note_count, h),
+                _read_column(f, 'q', note_count, h),
+                _read_column(f, 'B', note_count, h),
+            )
+            count += 1
+            yield session
+
+
+def _read_shards(path):
+    # Import here so the snapshot module has no import cycle with the store
+    from session_store import read_manifest, shard_file, load_sessions_file
+
+    try:
+        shard_count = read_manifest(path)
+    except (OSError, ValueError, KeyError) as e:
+        raise SnapshotError(f"Cannot read the shard manifest in {path}: {e}")
+    if shard_count is None:
+        raise SnapshotError(f"{path} is not a sharded data directory")
+
+    for i in range(shard_count):
+        shard_path = shard_file(path, i, shard_count)
+        # A shard that can't be read must fail the snapshot, not look empty
+        try:
+            sessions = load_sessions_file(shard_path)
+        except (OSError, ValueError) as e:
+            raise SnapshotError(f"Cannot read shard file {shard_path}: {e}")
+        yield from sessions.values()
+
+
+# ---------------------------------------------------------------------------
+# Writers
+# ---------------------------------------------------------------------------
+
+def write_sessions(sessions, path, fmt, shard_count=None):
+    """
+    Write sessions in the given format, streaming one session at a time
+
+    Args:
+        sessions: Iterable of Sessions
+        path: Destination file (or directory for 'shards')
+        fmt: One of FORMATS
+        shard_count: Shard count for the 'shards' format (optional)
+
+    Returns:
+        Dict with sessions, notes, bytes and sha256 (None for 'shards')
+    """
+    path = Path(path)
+    if fmt == 'shards':
+        return _write_shards(sessions, path, shard_count)
+
+    stats = {'sessions': 0, 'notes': 0}
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        out = _HashingWriter(f)
+        if fmt == 'binary':
+            _write_binary(sessions, out, stats)
+        else:
+            _write_json(sessions, out, stats, firebase=(fmt == 'firebase'))
+    os.replace(tmp_path, path)
+
+    stats['bytes'] = out.bytes
+    stats['sha256'] = out.sha256.hexdigest()
+    _write_sidecar(path, stats['sha256'])
+    return stats
+
+
+def _write_json(sessions, out, stats, firebase):
+    out.write('{"sessions": {' if firebase else '{')
+    for i, session in enumerate(sessions):
+        data = session.to_dict()
+        if firebase:
+            # Firebase stores lists as keyed children; fixed-width keys keep them in order
+            data['notes'] = {f'n{k:08d}': note for k, note in enumerate(data['notes'])}
+        # Object keys must be strings; str() matches what json.dumps does for dict keys
+        out.write((', ' if i else '') + json.dumps(str(session.id)) + ': ' + json.dumps(data))
+        stats['sessions'] += 1
+        stats['notes'] += len(session.notes)
+    out.write('}}' if firebase else '}')
+
+
+def _write_binary(sessions, out, stats):
+    out.write(BINARY_MAGIC)
+    for session in sessions:
+        meta = json.dumps([str(session.id), session.to_dict(include_notes=False)]).encode('utf-8')
+        out.write(_SESSION_RECORD)
+        out.write(struct.pack('<I', len(meta)))
+        out.write(meta)
+        out.write(struct.pack('<Q', len(session.notes)))
+        for column in session.notes.columns():
+            out.write(_little_endian(column))
+        stats['sessions'] += 1
+        stats['notes'] += len(session.notes)
+
+    # The trailer is not part of the hash it records
+    digest = out.sha256.digest()
+    out.write(_END_RECORD)
+    out.write(struct.pack('<Q', stats['sessions']))
+    out.write(digest)
+
+
+def _write_shards(sessions, path, shard_count):
+    from session_store import configured_shard_count, shard_file, shard_index, write_manifest
+
+    if path.exists() and any(path.iterdir()):
+        raise SnapshotError(f"{path} is not empty; restore into a new directory")
+    path.mkdir(parents=True, exist_ok=True)
+    shard_count = max(1, shard_count or configured_shard_count())
+
+    # Each session is appended to its shard's file as it arrives, so only
+    # one session is held in memory at a time
+    stats = {'sessions': 0, 'notes': 0, 'bytes': 0, 'sha256': None}
+    paths = [shard_file(path, i, shard_count) for i in range(shard_count)]
+    tmp_paths = [p.with_name(p.name + '.tmp') for p in paths]
+    files = [open(p, 'w') for p in tmp_paths]
+    try:
+        written = [0] * shard_count
+        for session in sessions:
+            i = shard_index(session.id, shard_count)
+            files[i].write((', ' if written[i] else '{') + json.dumps(str(session.id)) + ': ' +
+                           json.dumps(session.to_dict()))
+            written[i] += 1
+            stats['sessions'] += 1
+            stats['notes'] += len(session.notes)
+        for f, count in zip(files, written):
+            f.write('}' if count else '{}')
+    finally:
+        for f in files:
+            f.close()
+
+    for tmp_path, shard_path in zip(tmp_paths, paths):
+        os.replace(tmp_path, shard_path)
+        stats['bytes'] += shard_path.stat().st_size
+    # Written last, so a failed restore is never mistaken for a data directory
+    write_manifest(path, shard_count)
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# Snapshot and migration
+# ---------------------------------------------------------------------------
+
+def snapshot_store(store, path, fmt='binary'):
+    """
+    Write a consistent snapshot of a live ShardedSessionStore
+
+    Ingest is only blocked while sessions are copied in memory.
+
+    Returns:
+        Dict with counts, bytes, sha256, content digest and throughput
+    """
+    start = time.perf_counter()
+    sessions = store.snapshot()
+    copy_seconds = time.perf_counter() - start
+
+    stats = write_sessions(sessions.values(), path, fmt)
+    stats['contentDigest'] = content_digest(sessions.values())
+    stats['copySeconds'] = round(copy_seconds, 4)
+    return _with_throughput(stats, time.perf_counter() - start)
+
+
+def migrate(source, destination, source_format, destination_format, shard_count=None, verify=True):
+    """
+    Convert sessions between formats, streaming session by session
+
+    Args:
+        source: Source file or directory
+        destination: Destination file or directory
+        source_format: One of FORMATS
+        destination_format: One of FORMATS
+        shard_count: Shard count when writing the 'shards' format
+        verify: Re-read the destination and compare content digests
+
+    Returns:
+        Dict with counts, bytes, checksums and throughput
+
+    Raises:
+        SnapshotError: If a checksum does not match
+    """
+    start = time.perf_counter()
+    if source_format != 'shards':
+        verify_file(source)
+
+    # Digest the sessions as they stream past, without holding them all
+    source_digests = []
+
+    def tracked(sessions):
+        for session in sessions:
+            source_digests.append(_session_digest(session))
+            yield session
+
+    stats = write_sessions(tracked(read_sessions(source, source_format)),
+                           destination, destination_format, shard_count)
+    source_digest = _combine(source_digests)
+    stats['contentDigest'] = source_digest
+
+    if verify:
+        destination_digest = content_digest(read_sessions(destination, destination_format))
+        if destination_digest != source_digest:
+            raise SnapshotError(f"Content digest mismatch after migrating to {destination}")
+        stats['verified'] = True
+
+    return _with_throughput(stats, time.perf_counter() - start)
+
+
+def _with_throughput(stats, seconds):
+    stats['seconds'] = round(seconds, 3)
+    if seconds > 0:
+        stats['notesPerSecond'] = round(stats['notes'] / seconds)
+        stats['megabytesPerSecond'] = round(stats['bytes'] / seconds / (1024 * 1024), 2)
+    return stats
+
+
+def guess_format(path):
+    """
+    Format from a path: directories are shards, .pmsnap is binary,
+    .firebase.json is a Firebase export, anything else json
+    """
+    path = Path(path)
+    if path.is_dir():
+        return 'shards'
+    return _format_for_name(path.name) or 'json'
+
+
+def _format_for_name(name):
+    if name.endswith('.pmsnap'):
+        return 'binary'
+    if name.endswith('.firebase.json'):
+        return 'firebase'
+    if name.endswith('.json'):
+        return 'json'
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot, restore and migrate session data")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = commands.add_parser('migrate', help='convert between formats (also restore)')
+    migrate_parser.add_argument('source')
+    migrate_parser.add_argument('destination')
+    migrate_parser.add_argument('--from', dest='source_format', choices=FORMATS)
+    migrate_parser.add_argument('--to', dest='destination_format', choices=FORMATS)
+    migrate_parser.add_argument('--shards', type=int, help='shard count when writing a data directory')
+    migrate_parser.add_argument('--no-verify', action='store_true')
+
+    verify_parser = commands.add_parser('verify', help='check a snapshot file')
+    verify_parser.add_argument('path')
+    verify_parser.add_argument('--format', choices=FORMATS)
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'migrate':
+            destination_format = args.destination_format
+            if destination_format is None:
+                destination_format = _format_for_name(args.destination) or 'shards'
+            stats = migrate(args.source, args.destination,
+                            args.source_format or guess_format(args.source),
+                            destination_format, args.shards, not args.no_verify)
+        else:
+            fmt = args.format or guess_format(args.path)
+            sidecar_ok = fmt != 'shards' and verify_file(args.path)
+            sessions = list(read_sessions(args.path, fmt))
+            stats = {
+                'sessions': len(sessions),
+                'notes': sum(len(s.notes) for s in sessions),
+                'sidecarVerified': sidecar_ok,
+                'contentDigest': content_digest(sessions),
+            }
+    except (SnapshotError, OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
+import 'dart:async';
 import 'dart:convert';
+import 'dart:math';
 import 'package:http/http.dart' as http;
 import 'models/note_model.dart';
 
@@ -6,29 +8,144 @@ class LocalStorageService {
   final String _baseUrl = 'http://localhost:5000/api';
   late String _sessionId;
   
+  // Sequence number for the next note; the server drops retried duplicates by seq
+  int _nextSeq = 0;
+  
+  // Notes that failed to send, replayed in batches when the server is reachable
+  final List<Map<String, dynamic>> _pendingNotes = [];
+  static const int _maxBatchNotes = 10000;
+  
+  // The flush in progress, if any; only one runs at a time so the batch it
+  // removes from the head of the queue is always the one it sent
+  Future<void>? _flushing;
+  
+  // Batch size for the next replay; halved when the server rejects a batch
+  int _batchLimit = _maxBatchNotes;
+  
+  // Don't send before this time after the server answered 429
+  DateTime? _retryAt;
+  
+  // Retries queued notes after network or server errors, even if no new
+  // note is played
+  Timer? _retryTimer;
+  
   void initialize() {
     // Create a unique session ID for this practice session
     _sessionId = DateTime.now().millisecondsSinceEpoch.toString();
     
     // We don't need to initialize anything on the server side here
     // The first note sent will create the session
+    
+    _retryTimer?.cancel();
+    _retryTimer = Timer.periodic(const Duration(seconds: 5), (_) {
+      if (_pendingNotes.isNotEmpty) {
+        flushPendingNotes();
+      }
+    });
   }
   
   // Send note data to backend server
   Future<void> sendNoteData(NoteModel note) async {
+    final queuedNote = {...note.toJson(), 'seq': _nextSeq++};
+    
+    // Keep ordering: if earlier notes are still queued or being replayed,
+    // queue this one too
+    if (_pendingNotes.isNotEmpty || _flushing != null) {
+      _pendingNotes.add(queuedNote);
+      await flushPendingNotes();
+      return;
+    }
+    
     try {
       // Send note to backend for real-time notes and session history
-      await http.post(
+      final response = await http.post(
         Uri.parse('$_baseUrl/save-note'),
         headers: {'Content-Type': 'application/json'},
         body: jsonEncode({
-          'note': note.toJson(),
+          'note': queuedNote,
           'sessionId': _sessionId
         }),
       );
+      if (response.statusCode == 400) {
+        // Retrying a rejected note can't succeed
+        print('Server rejected note: ${response.body}');
+      } else if (response.statusCode == 429) {
+        // Replay once the server's back-off has passed
+        _backOff(response);
+        _pendingNotes.add(queuedNote);
+        await flushPendingNotes();
+      } else if (response.statusCode != 200) {
+        _pendingNotes.add(queuedNote);
+      }
     } catch (e) {
       print('Error sending note data to server: $e');
+      _pendingNotes.add(queuedNote);
+    }
+  }
+  
+  // Replay queued notes in large batches; safe to retry because of seq numbers.
+  // Concurrent callers share the flush already in progress.
+  Future<void> flushPendingNotes() {
+    return _flushing ??= _flush().whenComplete(() => _flushing = null);
+  }
+  
+  Future<void> _flush() async {
+    while (_pendingNotes.isNotEmpty) {
+      final retryAt = _retryAt;
+      if (retryAt != null && retryAt.isAfter(DateTime.now())) {
+        await Future.delayed(retryAt.difference(DateTime.now()));
+      }
+      
+      final count = min(_pendingNotes.length, _batchLimit);
+      final batch = _pendingNotes.sublist(0, count);
+      try {
+        final response = await http.post(
+          Uri.parse('$_baseUrl/save-notes'),
+          headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': '$_sessionId-${batch.first['seq']}-${batch.last['seq']}',
+          },
+          body: jsonEncode({
+            'notes': batch,
+            'sessionId': _sessionId
+          }),
+        );
+        if (response.statusCode == 200) {
+          _pendingNotes.removeRange(0, count);
+        } else if (response.statusCode == 429) {
+          _backOff(response);
+        } else if ((response.statusCode == 400 || response.statusCode == 413) && count > 1) {
+          // Split the batch until the rejected note (or a small enough batch) is found
+          _batchLimit = (count + 1) ~/ 2;
+        } else if (response.statusCode == 400) {
+          // A single note the server will never accept; drop it so it can't
+          // block the queue
+          print('Server rejected queued note: ${response.body}');
+          _pendingNotes.removeAt(0);
+          _batchLimit = _maxBatchNotes;
+        } else {
+          // Server trouble; the retry timer or the next note tries again
+          return;
+        }
+      } catch (e) {
+        print('Error replaying queued notes: $e');
+        return;
+      }
+    }
+  }
+  
+  // Remember how long the server asked us to wait after a 429
+  void _backOff(http.Response response) {
+    int retryAfterMs = 1000;
+    try {
+      retryAfterMs = (jsonDecode(response.body)['retryAfterMs'] as num).toInt();
+    } catch (_) {
+      final seconds = int.tryParse(response.headers['retry-after'] ?? '');
+      if (seconds != null) {
+        retryAfterMs = seconds * 1000;
+      }
     }
+    _retryAt = DateTime.now().add(Duration(milliseconds: retryAfterMs));
   }
   
   // Update session metadata (e.g., change mode, update session info)
@@ -44,6 +161,8 @@ class LocalStorageService {
   
   // Clean up resources
   Future<void> dispose() async {
+    _retryTimer?.cancel();
+    _retryTimer = null;
     try {
       // In a real app, this would mark the session as ended
       print('Session $sessionId ended');